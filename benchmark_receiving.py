@@ -0,0 +1,373 @@
+#!python3
+# -*- coding: UTF-8 -*-
+
+'''
+benchmark_receiving.py   Version 1.0
+    Runs the receiving utility end to end without a scanner or a desktop.
+    Scans come from scan_simulator's SimulatedSerial and keystrokes go to a
+    recorder that timestamps every event. Each version (receiving_v2.py to
+    receiving_v4.py) is driven through main and through bbbProcedure,
+    aaaProcedure and printDataProcedure directly, and each run reports
+    scan-to-first-keystroke latency (p50/p95/p99), time to complete a whole
+    receipt, correction or print, CPU per scan and memory. The results are
+    written as JSON so runs of different versions can be compared.
+
+    Versions 2 and 3 read the port without a terminator and sleep between
+    tabs, so they are fed one write per scan, each only once they are
+    waiting for it (the way an operator scans at the prompt), and keep
+    their sleeps. Version
+    4 runs without adaptive pacing unless --pacing is given. Runs the older
+    versions can't complete as published are skipped, see unsupported.
+
+Usage:
+    python benchmark_receiving.py [--versions v2,v3,v4] [--scenarios main,bbb,aaa,printData]
+                                  [--units 200] [--rate 20] [--burst 1] [--jitter]
+                                  [--fragment 0.0] [--coalesce 0.0] [--pacing]
+                                  [--memory] [--seed 1] [--output benchmark_results.json]
+'''
+
+####################
+#     IMPORTS      #
+####################
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import receiving_v4
+import scan_simulator
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+allVersions = ('v1', 'v2', 'v3', 'v4')
+allScenarios = ('main', 'bbb', 'aaa', 'printData')
+unsupported = {
+    'v1':'procedures use keyboard and ser globals that main never sets',
+    'v2 main':'main dispatches receipts on mode findReceipt, which modes has no entry for',
+    'v3 main':'modes has no bbb entry, so changing to receipts raises KeyError',
+    'v3 bbb':'modes has no bbb entry, so changing to receipts raises KeyError',
+    }
+
+####################
+#     SCRIPTS      #
+####################
+
+# Scans for unit &number of &scenario. Version 4 takes one QR code per
+# receipt, older versions a scan per field
+def unitScans(version, scenario, number):
+
+    PO, IN, Q = str(100000 + number), 'ITEM-' + str(number % 97), str(number % 9 + 1)
+    sub = 'bypassSub' if number % 2 else 'SUB' + str(number % 5)
+    if scenario == 'printData':
+        return ['PRINT-' + str(number)]
+    if version == 'v4':
+        QR = PO + '#' + IN + '#1#' + Q
+        if scenario == 'aaa':
+            return [QR, 'confirm', 'confirm']
+        return [QR, sub, 'setMode:findReceipt']
+    if scenario == 'aaa':
+        return [PO, IN, Q, Q]
+    return [PO, IN, Q, sub, 'setMode:bbb']
+
+####################
+#    RECORDING     #
+####################
+
+# Keeps the first and last keystroke time of every scan the utility reads
+class TimedRecorder(receiving_v4.OutputBackend):
+    def __init__(self, scans):
+        self.first = [None] * scans
+        self.last = [None] * scans
+        self.scan = -1
+        self.events = 0
+        self.waiting = threading.Event()
+        self.finished = None
+
+    # Called when the run is over, before anything is cleaned up
+    def finish(self):
+        if self.finished is None:
+            self.finished = (time.monotonic(), time.process_time())
+
+    # Called each time the utility reads a scan
+    def read(self):
+        self.scan += 1
+
+    def event(self):
+        now = time.monotonic()
+        self.events += 1
+        if 0 <= self.scan < len(self.first):
+            if self.first[self.scan] is None:
+                self.first[self.scan] = now
+            self.last[self.scan] = now
+
+    def press(self, key):
+        self.event()
+
+    def release(self, key):
+        self.event()
+
+    def type(self, text):
+        self.event()
+
+    # pynput's Controller.pressed, used by versions 2 and 3
+    @contextlib.contextmanager
+    def pressed(self, *keys):
+        for key in keys:
+            self.press(key)
+        try:
+            yield
+        finally:
+            for key in reversed(keys):
+                self.release(key)
+
+# Set attributes of &module for the length of a run, then put them back
+@contextlib.contextmanager
+def patched(module, **values):
+    saved = {name:getattr(module, name) for name in values if hasattr(module, name)}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name in values:
+            if name in saved:
+                setattr(module, name, saved[name])
+            else:
+                delattr(module, name)
+
+####################
+#      RUNS        #
+####################
+
+# Run &scenario of &module on &ser, sending keystrokes to &recorder
+def drive(version, module, scenario, ser, recorder, units, args, folder):
+
+    original = module.nextScan
+    def nextScan(*a, **k):
+        recorder.waiting.set()
+        data = original(*a, **k)
+        recorder.waiting.clear()
+        if len(data) > 0:
+            recorder.read()
+        return data
+
+    with patched(module, nextScan=nextScan):
+        if scenario == 'main':
+            driveMain(version, module, ser, recorder, args, folder)
+            return
+
+        procedure = getattr(module, scenario + 'Procedure')
+        if version == 'v4':
+            source = module.ScanPump(module.ScanReader(ser)).start()
+            values = {'pacer':module.Pacer() if args.pacing else None}
+        else:
+            source, values = ser, {}
+        with patched(module, **values):
+            try:
+                for _ in range(units):
+                    procedure(recorder, source)
+                recorder.finish()
+            finally:
+                if version == 'v4':
+                    ser.close()
+                    source.close()
+
+# Run main of &module with its port, keyboard and log folder replaced
+def driveMain(version, module, ser, recorder, args, folder):
+
+    values = {'setupCOMPort':lambda *a: ser}
+    if version == 'v4':
+        values.update(scannerFolder=lambda user: folder + os.sep, outputBackend='benchmark',
+                      adaptivePacing=args.pacing)
+        module.outputBackends['benchmark'] = lambda: recorder
+    else:
+        values['Controller'] = lambda: recorder
+        if hasattr(module, 'openLogFile'):
+            values['openLogFile'] = lambda user: open(os.path.join(folder, 'ReceivingLog.txt'), 'a')
+    with patched(module, **values):
+        try:
+            module.main()
+        except SystemExit:
+            recorder.finish()
+        finally:
+            if version == 'v4':
+                module.closeLog()
+                for name in ('scanJournal', 'scanCache', 'scanQueue'):
+                    if getattr(module, name, None) is not None:
+                        getattr(module, name).close()
+                        setattr(module, name, None)
+                module.masterData = module.pacer = None
+                del module.outputBackends['benchmark']
+
+# Value at &fraction of sorted &values, nearest rank
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def summary(values):
+    values = sorted(values)
+    return {
+        'count':len(values),
+        'p50':percentile(values, 0.50),
+        'p95':percentile(values, 0.95),
+        'p99':percentile(values, 0.99),
+        'max':values[-1] if values else None,
+        'mean':sum(values) / len(values) if values else None,
+        }
+
+# Benchmark one scenario of one version and return its results
+def runScenario(version, module, scenario, args):
+
+    units = [unitScans(version, scenario, number) for number in range(args.units)]
+    script = [scan for unit in units for scan in unit]
+    starts = []
+    first = 1 if scenario == 'main' else 0
+    for unit in units:
+        starts.append(first)
+        first += len(unit)
+    if scenario == 'main':
+        script = ['setMode:bbb'] + script + ['setMode:exit', 'setMode:exit']
+
+    legacy = version != 'v4'
+    recorder = TimedRecorder(len(script))
+    ser = scan_simulator.SimulatedSerial(timeout=0 if legacy else None)
+
+    # Older versions read whatever is waiting as one scan
+    def feedRead(data):
+        while (ser.in_waiting > 0 or not recorder.waiting.wait(0.1)) and ser.is_open:
+            time.sleep(0.001)
+        ser.feed(data)
+
+    feeder = scan_simulator.ScanFeeder(
+        feedRead if legacy else ser.feed, script, rate=args.rate, burst=args.burst, jitter=args.jitter,
+        fragment=0.0 if legacy else args.fragment, coalesce=0.0 if legacy else args.coalesce,
+        seed=args.seed, terminator=b'' if legacy else scan_simulator.terminator)
+
+    if args.memory:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as folder, open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            cpu = time.process_time()
+            started = time.monotonic()
+            feeder.start()
+            try:
+                drive(version, module, scenario, ser, recorder, len(units), args, folder)
+            finally:
+                feeder.stop()
+                ser.close()
+    recorder.finish()
+    elapsed = recorder.finished[0] - started
+    cpu = recorder.finished[1] - cpu
+    memory = {}
+    if args.memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory.update(tracedKB=current / 1024, peakKB=peak / 1024)
+    if resource is not None:
+        memory['maxRssKB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    sent = list(feeder.sent)
+    read = recorder.scan + 1
+    latency = [1000 * (recorder.first[scan] - sent[scan])
+               for scan in range(min(read, len(sent))) if recorder.first[scan] is not None]
+    completion = []
+    for start, unit in zip(starts, units):
+        ends = [recorder.last[scan] for scan in range(start, start + len(unit)) if recorder.last[scan] is not None]
+        if len(ends) > 0 and start < len(sent):
+            completion.append(1000 * (max(ends) - sent[start]))
+
+    return {
+        'version':version,
+        'scenario':scenario,
+        'units':len(units),
+        'scansSent':feeder.frames,
+        'scansRead':read,
+        'keystrokeEvents':recorder.events,
+        'elapsedS':elapsed,
+        'scansPerS':read / elapsed if elapsed > 0 else None,
+        'unitsPerMin':60 * len(completion) / elapsed if elapsed > 0 else None,
+        'latencyMs':summary(latency),
+        'completionMs':summary(completion),
+        'cpuMsPerScan':1000 * cpu / read if read > 0 else None,
+        'memory':memory,
+        }
+
+####################
+#       MAIN       #
+####################
+
+def formatMs(value):
+    return '-' if value is None else '%.2f' % value
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark the receiving utility headless.')
+    parser.add_argument('--versions', default=','.join(allVersions), help='versions to run, e.g. v3,v4')
+    parser.add_argument('--scenarios', default=','.join(allScenarios), help='main and/or procedures to run')
+    parser.add_argument('--units', type=int, default=200, help='receipts, corrections or prints per run')
+    parser.add_argument('--rate', type=float, default=20.0, help='average scans per second sent')
+    parser.add_argument('--burst', type=int, default=1, help='scans sent back to back')
+    parser.add_argument('--jitter', action='store_true', help='Poisson gaps between bursts')
+    parser.add_argument('--fragment', type=float, default=0.0, help='chance a scan is split (v4 only)')
+    parser.add_argument('--coalesce', type=float, default=0.0, help='chance a scan runs into the next (v4 only)')
+    parser.add_argument('--pacing', action='store_true', help='keep version 4 adaptive pacing on')
+    parser.add_argument('--memory', action='store_true', help='trace Python allocations (slower)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the scan schedule')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    args = parser.parse_args(argv)
+
+    results = []
+    skipped = {}
+    for version in args.versions.split(','):
+        if version in unsupported:
+            skipped[version] = unsupported[version]
+            continue
+        try:
+            module = importlib.import_module('receiving_' + version)
+        except ImportError as e:
+            skipped[version] = 'unable to import: ' + str(e)
+            continue
+        for scenario in args.scenarios.split(','):
+            if version + ' ' + scenario in unsupported:
+                skipped[version + ' ' + scenario] = unsupported[version + ' ' + scenario]
+                continue
+            try:
+                result = runScenario(version, module, scenario, args)
+            except Exception as e:
+                skipped[version + ' ' + scenario] = 'failed: ' + repr(e)
+                continue
+            results.append(result)
+            print('%-3s %-9s %6d scans %8.1f/s  latency p50 %s p95 %s p99 %s ms  '
+                  'complete p50 %s ms  cpu %s ms/scan'
+                  % (version, scenario, result['scansRead'], result['scansPerS'] or 0.0,
+                     formatMs(result['latencyMs']['p50']), formatMs(result['latencyMs']['p95']),
+                     formatMs(result['latencyMs']['p99']), formatMs(result['completionMs']['p50']),
+                     formatMs(result['cpuMsPerScan'])))
+    for version, reason in skipped.items():
+        print(version + ' skipped: ' + reason)
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'started':time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python':sys.version.split()[0],
+            'platform':platform.platform(),
+            'settings':vars(args),
+            'skipped':skipped,
+            'results':results,
+            }, output, indent=2)
+    print('Results written to ' + args.output)
+
+if __name__ == "__main__":
+    main()
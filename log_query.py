@@ -0,0 +1,321 @@
+#!python3
+# -*- coding: UTF-8 -*-
+
+'''
+log_query.py   Version 1.0
+    Streams the receiving utility's log files (ReceivingLog.txt, the
+    ReceivingLog.*.txt archives, gzipped or not yet, and the older
+    ReceivingLogOld.txt) and prints the lines matching a time range, mode,
+    PO or item number, or a summary of each scanner session. Files are
+    read a line at a time from a large buffer, so memory use stays flat
+    however big the logs get.
+    With --journal, the PO or item is looked up in the scan journal
+    (ScanJournal.jsonl) through its index instead, and each record found
+    is printed as it was journaled.
+
+Usage:
+    python log_query.py [--since "2019-08-12 06:00"] [--until ...]
+                        [--mode bbb] [--po 12345] [--item ABC-1]
+                        [--summary] [--folder PATH] [FILE ...]
+    python log_query.py --journal [--po 12345] [--item ABC-1] [--folder PATH]
+'''
+
+####################
+#     IMPORTS      #
+####################
+
+import argparse
+import getpass
+import gzip
+import json
+import os
+import os.path
+import sys
+
+# Line formats written by receiving_v4.py
+stampLength = 19                                # 'YYYY-MM-DD HH:MM:SS'
+separator = ' : '
+borderText = '*******'
+headerText = '*    RECEIVING BARCODE SCANNER UTILITY    *'
+footerText = '*              Exiting script             *'
+userText = 'Current User: '
+modeText = 'MODE CHANGED TO: '
+currentModeText = 'MODE: '                      # Mode each procedure starts in, e.g. after a receipt
+enteredText = 'Entered '
+fieldTexts = {
+    ' into \'Purchase Order\' field':'PO',
+    ' into \'Item, Rev\' field':'item',
+    ' into \'Quantity\' field':'quantity',
+    ' into \'subinventory\' field':'subinventory',
+    ' into \'Correction\' field':'correction',
+    }
+# Prompts that start a new receipt or correction
+startTexts = ('Waiting for Receipt QR scan...', 'Waiting for Correction QR scan...')
+journalFile = 'ScanJournal.jsonl'
+journalIndexFile = 'ScanJournal.idx'
+# Lines counted as problems in session summaries
+problemTexts = ('UNEXPECTED SCAN', 'SCAN DISCARDED', 'SCAN REJECTED', 'SCANNER READ FAILED',
+                'SCANNER NOT FOUND', 'SCANNER SESSION FAILED', 'UNABLE TO', 'KeyboardInterrupt',
+                'SCAN QUEUE FULL', 'INVALID QR CODE', 'NOT AN OPEN LINE', 'MODE TIMED OUT',
+                'SCANNER PORT NOT RESPONDING', 'REPLAY HELD', 'BATCH LINE HELD', 'HOUSEKEEPING FAILED')
+
+####################
+#    FUNCTIONS     #
+####################
+
+# Default folder holding the logs for the current user
+def defaultFolder():
+    return os.path.join('C:\\Users', getpass.getuser(), 'AppData', 'Scanner')
+
+# Log files in &folder, oldest first. Archives still waiting to be
+# compressed, or that failed to, are read as they are
+def logFiles(folder):
+
+    names = os.listdir(folder) if os.path.isdir(folder) else []
+    archives = sorted((name for name in names if name.startswith('ReceivingLog.') and name != 'ReceivingLog.txt'
+                       and (name.endswith('.txt.gz') or name.endswith('.txt') and name + '.gz' not in names)),
+                      key=lambda name: name[:-3] if name.endswith('.gz') else name)
+    files = []
+    if 'ReceivingLogOld.txt' in names:
+        files.append('ReceivingLogOld.txt')
+    files += archives
+    if 'ReceivingLog.txt' in names:
+        files.append('ReceivingLog.txt')
+    return [os.path.join(folder, name) for name in files]
+
+# Yield the journal records for &PO and/or &item, oldest first. Only the
+# index is streamed, each matching record is read with one seek
+def journalRecords(folder, PO=None, item=None):
+
+    wanted = {kind:key for kind, key in (('P', PO), ('I', item)) if key is not None}
+    found = {kind:set() for kind in wanted}
+    with open(os.path.join(folder, journalIndexFile), encoding='utf-8', errors='replace') as index:
+        for line in index:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 3 and wanted.get(fields[0]) == fields[1] and fields[2].isdigit():
+                found[fields[0]].add(int(fields[2]))
+    offsets = set.intersection(*found.values()) if found else set()
+
+    with open(os.path.join(folder, journalFile), 'rb') as journal:
+        for offset in sorted(offsets):
+            journal.seek(offset)
+            try:
+                yield json.loads(journal.readline())
+            except ValueError:
+                continue
+
+# Print the journal records for --po/--item that pass the other filters
+def queryJournal(folder, args, out=sys.stdout):
+
+    mode = args.mode.lower() if args.mode else None
+    for record in journalRecords(folder, args.po, args.item):
+        stamp = record.get('time', '')
+        if (args.since and stamp < args.since) or (args.until and stamp > args.until):
+            continue
+        if mode is not None and mode not in str(record.get('mode', '')).lower():
+            continue
+        out.write(json.dumps(record) + '\n')
+
+# Yield the lines of &path as text, reading it in 1MB chunks
+def readLines(path):
+
+    if path.endswith('.gz'):
+        stream = gzip.open(path, 'rb')
+    else:
+        stream = open(path, 'rb', buffering=1024 * 1024)
+    with stream:
+        for line in stream:
+            yield line.decode('utf-8', 'replace').rstrip('\r\n')
+
+# Split a log &line into (timestamp, port, text), port is None untagged
+def splitLine(line):
+
+    if len(line) < stampLength + len(separator) or line[stampLength:stampLength + 3] != separator:
+        return None, None, line
+    stamp = line[:stampLength]
+    text = line[stampLength + 3:]
+    port = None
+    if text[:1] == '[':
+        end = text.find('] ')
+        if end > 0:
+            port, text = text[1:end], text[end + 2:]
+    return stamp, port, text
+
+# Return (field, value) for an 'Entered X into ...' line, otherwise None
+def enteredField(text):
+
+    if not text.startswith(enteredText):
+        return None
+    for suffix, field in fieldTexts.items():
+        if text.endswith(suffix):
+            return field, text[len(enteredText):-len(suffix)]
+    return None
+
+# Receipt being worked on by one scanner, as far as the log shows
+class ScannerState(object):
+    def __init__(self):
+        self.mode = ''
+        self.PO = None
+        self.item = None
+
+# Totals for one run of the utility, from its header to its footer
+class Session(object):
+    def __init__(self, path, stamp):
+        self.path = path
+        self.start = stamp
+        self.end = stamp
+        self.user = ''
+        self.receipts = 0
+        self.corrections = 0
+        self.modeChanges = 0
+        self.problems = 0
+        self.lines = 0
+        self.closed = False
+
+    def report(self):
+        state = 'exited' if self.closed else 'no exit logged'
+        return (self.start + ' -> ' + self.end + '  user=' + (self.user or '?')
+                + '  receipts=' + str(self.receipts) + '  corrections=' + str(self.corrections)
+                + '  modeChanges=' + str(self.modeChanges) + '  problems=' + str(self.problems)
+                + '  lines=' + str(self.lines) + '  (' + state + ', ' + os.path.basename(self.path) + ')')
+
+# Print the summary of &session unless it ended before --since
+def report(session, args, out):
+    if not args.since or session.end >= args.since:
+        out.write(session.report() + '\n')
+
+# Stream every line of &paths through the filters in &args, printing
+# matching lines or, with --summary, one line per session
+def query(paths, args, out=sys.stdout):
+
+    mode = args.mode.lower() if args.mode else None
+    scanners = {}
+    session = None
+    matched = 0
+
+    for path in paths:
+        for line in readLines(path):
+            stamp, port, text = splitLine(line)
+            if stamp is None:
+                continue
+            if args.until and stamp > args.until:
+                break # logs are written in time order
+
+            # Sessions start at the header and end at the footer
+            if text.startswith(headerText):
+                if session is not None and args.summary:
+                    report(session, args, out)
+                session = Session(path, stamp)
+                scanners = {}
+            elif session is None:
+                if text.startswith(borderText):
+                    continue # header border before the first session
+                session = Session(path, stamp)
+            session.end = stamp
+            session.lines += 1
+
+            # Follow mode and receipt per scanner
+            scanner = scanners.get(port)
+            if scanner is None:
+                scanner = scanners[port] = ScannerState()
+            if text.startswith(modeText):
+                scanner.mode = text[len(modeText):].strip('\'').lower()
+                session.modeChanges += 1
+            elif text.startswith(currentModeText):
+                scanner.mode = text[len(currentModeText):].strip('\'').lower()
+            elif text in startTexts:
+                scanner.PO = scanner.item = None
+            else:
+                entered = enteredField(text)
+                if entered is not None:
+                    field, value = entered
+                    if field == 'PO':
+                        scanner.PO, scanner.item = value, None
+                    elif field == 'item':
+                        scanner.item = value
+                    elif field == 'quantity':
+                        session.receipts += 1
+                    elif field == 'correction':
+                        session.corrections += 1
+                elif userText in text:
+                    session.user = text.split(userText, 1)[1].strip(' *')
+                elif text.startswith(footerText):
+                    session.closed = True
+                elif text.startswith(problemTexts):
+                    session.problems += 1
+
+            if args.summary:
+                continue
+
+            # Filter the line itself
+            if args.since and stamp < args.since:
+                continue
+            if mode is not None and mode not in scanner.mode:
+                continue
+            if args.po is not None and scanner.PO != args.po:
+                continue
+            if args.item is not None and scanner.item != args.item:
+                continue
+            out.write(line + '\n')
+            matched += 1
+
+    if session is not None and args.summary:
+        report(session, args, out)
+    return matched
+
+# Accept 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or a full timestamp, filling in
+# the missing part from &padding
+def timeArgument(value, padding=' 00:00:00'):
+
+    if len(value) in (10, 16):
+        value += padding[len(value) - 10:]
+    if len(value) != stampLength:
+        raise argparse.ArgumentTypeError('expected YYYY-MM-DD [HH:MM[:SS]]: ' + value)
+    return value
+
+# --until includes the whole day, hour or minute it names
+def untilArgument(value):
+    return timeArgument(value, ' 23:59:59')
+
+####################
+#       MAIN       #
+####################
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Search the receiving scanner logs.')
+    parser.add_argument('files', nargs='*', help='log files to read (default: every log in --folder)')
+    parser.add_argument('--folder', default=None, help='folder holding the logs')
+    parser.add_argument('--since', type=timeArgument, help='first time to show')
+    parser.add_argument('--until', type=untilArgument, help='last time to show')
+    parser.add_argument('--mode', help='only lines logged in a mode whose name contains this')
+    parser.add_argument('--po', help='only lines for this purchase order')
+    parser.add_argument('--item', help='only lines for this item number')
+    parser.add_argument('--summary', action='store_true', help='print one line per session')
+    parser.add_argument('--journal', action='store_true', help='look up --po/--item in the scan journal')
+    args = parser.parse_args(argv)
+
+    if args.journal:
+        if args.po is None and args.item is None:
+            parser.error('--journal needs --po or --item')
+        try:
+            queryJournal(args.folder or defaultFolder(), args)
+        except FileNotFoundError as e:
+            parser.error('no scan journal: ' + str(e))
+        except BrokenPipeError:
+            pass
+        return
+
+    paths = args.files or logFiles(args.folder or defaultFolder())
+    if len(paths) == 0:
+        parser.error('no log files found')
+
+    try:
+        query(paths, args)
+    except BrokenPipeError:
+        pass # output piped into head or more and closed early
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!python3
+# -*- coding: UTF-8 -*-
+
+'''
+microbench.py   Version 1.0
+    Times the helpers receiving_v4.py runs on every scan, in isolation:
+    nextScan and its decode, checkModeChange, changeMode, separateQR and
+    parseScan, the printLog timestamp and printLog itself, and pressTab.
+    Each is reported in microseconds per call, checked against its budget
+    below and against this machine's baseline, and the run exits non-zero
+    if any helper is over budget or slower than the baseline by more than
+    the tolerance. Timings only compare on the same machine and Python, so
+    the baseline is recorded locally with --save and named after both, it
+    is not kept in the repository. Log lines go to a LogWriter on os.devnull and keystrokes to
+    the null backend, so neither disk nor desktop is measured.
+
+Usage:
+    python microbench.py --save          record this machine's baseline
+    python microbench.py                 compare with it
+    python microbench.py --only separateQR,checkModeChange
+'''
+
+####################
+#     IMPORTS      #
+####################
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+import receiving_v4 as receiving
+
+baselineName = ('microbench_baseline.%s-%s-py%d.%d.json'
+                % ((platform.system(), platform.machine()) + sys.version_info[:2])).lower()
+baselineFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), baselineName)
+tolerance = 0.5         # Fraction slower than the baseline counted as a regression
+
+# Microseconds per call each helper must stay under
+budgets = {
+    'decodeScan':5.0,
+    'nextScan':20.0,
+    'checkModeChange':1.0,
+    'changeMode':20.0,
+    'separateQR':5.0,
+    'parseScan':10.0,
+    'timeStamp':2.0,
+    'printLog':10.0,
+    'pressTab':30.0,
+    }
+
+####################
+#    BENCHMARKS    #
+####################
+
+# Serves the same raw scan forever, in place of a ScanPump
+class RepeatScanner(object):
+    def __init__(self, frame):
+        self.frame = frame
+
+    def readScan(self, timeout=None):
+        return self.frame
+
+frame = b'1234567#ABC-1001-02#3#12\r\n'
+QRText = '1234567#ABC-1001-02#3#12'
+scanner = RepeatScanner(frame)
+keyboard = receiving.NullBackend()
+
+# Name -> function making one call of that helper
+benchmarks = {
+    'decodeScan':lambda: receiving.decodeScan(frame),
+    'nextScan':lambda: receiving.nextScan('Waiting for Receipt QR scan...', scanner),
+    'checkModeChange':lambda: receiving.checkModeChange('setMode:bbb'),
+    'changeMode':lambda: receiving.changeMode('setMode:bbb'),
+    'separateQR':lambda: receiving.separateQR(QRText),
+    'parseScan':lambda: receiving.parseScan(QRText),
+    'timeStamp':receiving.timeStamp,
+    'printLog':lambda: receiving.printLog('Entered 1234567 into \'Purchase Order\' field'),
+    'pressTab':lambda: receiving.pressTab(keyboard, 7),
+    }
+
+# Best of &repeat timings of &function, in microseconds per call
+def measure(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * pow(10, 6)
+
+####################
+#       MAIN       #
+####################
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Microbenchmark the per-scan helpers of receiving_v4.py.')
+    parser.add_argument('--only', help='comma separated helpers to run')
+    parser.add_argument('--repeat', type=int, default=7, help='timings per helper, the best is kept')
+    parser.add_argument('--tolerance', type=float, default=tolerance, help='fraction slower than the baseline allowed')
+    parser.add_argument('--baseline', default=baselineFile, help='baseline file to compare with')
+    parser.add_argument('--save', action='store_true', help='store this run as the baseline')
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',') if args.only else list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            parser.error('unknown helper ' + name + ', choose from ' + ', '.join(benchmarks))
+
+    baseline = {}
+    if not args.save:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as stored:
+                baseline = json.load(stored)['results']
+        else:
+            print('No baseline at ' + args.baseline + ', checking budgets only. Run with --save to record one')
+
+    receiving.pacer = None
+    receiving.logWriter = receiving.LogWriter(open(os.devnull, 'w')).start()
+    try:
+        results = {name:measure(benchmarks[name], args.repeat) for name in names}
+
+        # Time anything that looks slower again before calling it, one run can be noisy
+        for name in names:
+            if results[name] > budgets[name] or results[name] > baseline.get(name, results[name]) * (1 + args.tolerance):
+                results[name] = min(results[name], measure(benchmarks[name], args.repeat))
+    finally:
+        receiving.closeLog()
+        receiving.logWriter = None
+
+    failures = 0
+    print('%-16s %10s %10s %10s' % ('helper', 'us/call', 'budget', 'baseline'))
+    for name in names:
+        cost = results[name]
+        notes = []
+        if cost > budgets[name]:
+            notes.append('OVER BUDGET')
+        if name in baseline and cost > baseline[name] * (1 + args.tolerance):
+            notes.append('REGRESSION +%.0f%%' % (100 * (cost / baseline[name] - 1)))
+        failures += len(notes) > 0
+        print('%-16s %10.3f %10.3f %10s  %s' % (name, cost, budgets[name],
+              '%.3f' % baseline[name] if name in baseline else '-', ' '.join(notes)))
+
+    if args.save:
+        with open(args.baseline, 'w') as stored:
+            json.dump({
+                'python':sys.version.split()[0],
+                'platform':platform.platform(),
+                'results':results,
+                }, stored, indent=2)
+        print('Baseline written to ' + args.baseline)
+    return 1 if failures > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,75 +18,1449 @@ Last Updated: 08/12/2019
 #     IMPORTS      #
 ####################
 
-from pynput.keyboard import Key, Controller
+try:
+    from pynput.keyboard import Key, Controller
+except ImportError: # headless, only the recorder and null backends work
+    Key = Controller = None
+import asyncio
+import atexit
+import collections
+import contextlib
+import csv
 import datetime
+import functools
 import getpass
+import gzip
+import importlib.metadata
+import json
 import os
 import os.path
+import queue
 import re
 import serial
 import serial.tools.list_ports
+import shutil
+import sqlite3
 import sys
+import threading
 import time
 
+# Mode handler registered under &name. &label is the text shown in the log,
+# &procedure(keyboard, ser) runs one pass of the mode and returns the next
+# mode, or None to stop. &transitions limits which registered modes it may
+# change to (None allows any). A mode that acts on scans has &waitsForScan,
+# one that runs straight through, like a replay, starts without one.
+class ModeHandler(object):
+    def __init__(self, name, label, procedure=None, transitions=None, waitsForScan=True):
+        self.name = name
+        self.label = label
+        self.procedure = procedure
+        self.asyncProcedure = None
+        self.transitions = transitions
+        self.waitsForScan = waitsForScan
+
+    # Return &mode if this handler may change to it, otherwise stay put
+    def nextMode(self, mode):
+        if self.transitions is None or mode in self.transitions or mode not in modeRegistry:
+            return mode
+        printLog('MODE CHANGE NOT ALLOWED: ' + self.label + ' TO ' + modeRegistry[mode].label)
+        return self.name
+
 # Initialize Modes
-modes = {
-    'exit':'\'Exit Script\'',
-    '### aaa ###':'\'### AAA ###\'',
-    '### bbb ###':'\'### BBB ###\'',
-    'printData':'\'Print Data\''
+modeRegistry = {}
+
+# Decorator registering a procedure as the handler for mode &name
+def registerMode(name, label, transitions=None, waitsForScan=True):
+    def register(procedure):
+        handler = modeRegistry.get(name)
+        if handler is None:
+            modeRegistry[name] = ModeHandler(name, label, procedure, transitions, waitsForScan)
+        else:
+            handler.label, handler.procedure, handler.transitions = label, procedure, transitions
+            handler.waitsForScan = waitsForScan
+        return procedure
+    return register
+
+# Decorator registering a coroutine as the asyncio engine's handler for &name
+def registerAsyncMode(name):
+    def register(procedure):
+        modeRegistry[name].asyncProcedure = procedure
+        return procedure
+    return register
+
+# Import modes installed by other packages under the 'receiving.modes'
+# entry point group, they register themselves with the decorators above
+def loadModePlugins():
+    try:
+        plugins = importlib.metadata.entry_points(group='receiving.modes')
+    except TypeError:
+        plugins = importlib.metadata.entry_points().get('receiving.modes', [])
+    for plugin in plugins:
+        try:
+            plugin.load()
+        except Exception as e:
+            printLog('UNABLE TO LOAD MODE PLUGIN ' + plugin.name + ': ' + repr(e))
+
+# Initialize Duplicate Scan Check
+dedupeTTL = 8 * 3600    ### <-- ENTER SECONDS A SCAN COUNTS AS A DUPLICATE (0 = off) ###
+dedupeSize = 10000      # Most recent scans remembered
+dedupePersist = True    ### <-- ENTER False TO FORGET SCANS WHEN THE SCRIPT EXITS ###
+overrideScan = 'overrideDup' # Scan before a duplicate to enter it anyway
+
+# Initialize Open Line Check
+masterDataFile = 'OpenLines.csv' ### <-- ENTER EXPORT OF OPEN PO LINES (.csv OR .db), '' = off ###
+masterDataPolicy = 'refuse' ### <-- ENTER 'refuse' TO SKIP OR 'flag' TO LOG AND ENTER ###
+masterDataCheck = 5.0   # Seconds between checks of the export for changes
+
+# Initialize Offline Queue
+queueFile = 'ScanQueue.db' # Receipts scanned in offline mode, kept until replayed
+
+# Initialize Batch Import
+batchFile = 'BatchImport.txt' # One payload per line, optionally a tab and the subinventory/bypass answer
+batchAnswer = 'bypassSub' ### <-- ENTER SUBINVENTORY FOR RECEIPT LINES WITHOUT ONE ###
+batchQueueSize = 32     # Lines parsed ahead of the keystrokes
+
+# Initialize Payload Formats
+delimiterVariants = ('|', ';') # Tried when a scan isn't PO#IN#L#Q
+gs1Fields = {           ### <-- ENTER GS1 APPLICATION IDENTIFIERS FOR EACH FIELD ###
+    'PO':('400',),      # Customer purchase order number
+    'IN':('241', '01'), # Customer part number, then GTIN
+    'L':('91',),        # Company internal information (PO line)
+    'Q':('30', '37'),   # Variable count, then count of trade items
+    }
+
+# Initialize Scanner Settings
+scannerDescription = '##### BARCODE SCANNER DESCRIPTION TO MATCH #####'
+scannerPort = None      ### <-- ENTER A PORT (e.g. 'COM3' OR A SIMULATOR PTY) TO SKIP THE SEARCH ###
+multiPort = False       ### <-- ENTER True TO SERVE EVERY MATCHING SCANNER ###
+readTimeout = 0.5       ### <-- ENTER IDLE WAKE-UP IN SECONDS HERE ###
+scanTerminators = b'\r\n' ### <-- ENTER SCAN TERMINATOR BYTES (CR/LF/GS/ETX) HERE ###
+scanGapTimeout = 0.05   ### <-- ENTER INTER-BYTE GAP THAT ENDS A SCAN IN SECONDS ###
+maxScanLength = 4096    # Largest scan in bytes before the buffer is discarded
+maxPendingScans = 64    # Whole scans held before the oldest is dropped
+scanEncoding = 'utf-8'  ### <-- ENTER SCANNER CHARACTER SET HERE ###
+fnc1Separator = '\x1d'  ### <-- ENTER TEXT TO REPLACE GS1 FNC1 (GS) SEPARATORS ###
+scanQueueSize = 16      ### <-- ENTER NUMBER OF SCANS TO ALLOW AHEAD OF TYPING ###
+backpressure = 'block'  ### <-- ENTER 'block', 'dropOldest' OR 'beep' WHEN FULL ###
+asyncEngine = False     ### <-- ENTER True TO RUN THE ASYNCIO ENGINE ###
+modeTimeout = None      ### <-- ENTER SECONDS IDLE BEFORE DEFAULT MODE (None = never, asyncio engine only) ###
+resumeWorkflows = True  ### <-- ENTER False TO RESTART RECEIPTS AFTER ANOTHER MODE ###
+
+# Initialize Keystroke Output
+outputBackend = 'pynput' ### <-- ENTER 'recorder' OR 'null' TO RUN WITHOUT A DESKTOP ###
+
+# Initialize Latency Tracing
+latencyTracing = False  ### <-- ENTER True TO TIME EACH STAGE OF EVERY SCAN ###
+traceSize = 4096        # Most recent timing spans kept in memory
+traceFile = 'ScanTimings.jsonl' # Written beside the log by setMode:timings and by housekeeping
+traceFlushInterval = 60.0 # Seconds between writes of the trace file by housekeeping
+
+# Initialize Keystroke Pacing
+adaptivePacing = True   ### <-- ENTER False TO SEND KEYSTROKES WITHOUT DELAYS ###
+pacingProfile = {       # Starting delay in seconds after each macro step
+    'key':0.0,
+    'type':0.02,
+    'tab':0.02,
+    'shift+tab':0.02,
+    'enter':0.05,
+    'shift+shift_r+page_down':0.05,
+    'alt+w':0.05,
+    'f4':0.1,
+    'ctrl+s':0.2,
+    'window':0.3,       # Expected time for Oracle to change windows
     }
-# Initialize QR Code Struct
+windowTimeout = 2.0     ### <-- ENTER LONGEST WAIT FOR ORACLE TO CHANGE WINDOWS ###
+
+# Initialize Logging
+logFlushInterval = 1.0  ### <-- ENTER LONGEST TIME A LOG LINE WAITS TO BE FLUSHED ###
+logFlushLines = 64      # Log lines written before a flush is forced
+logMaxSize = 100        ### <-- ENTER SIZE LIMIT IN MB HERE ###
+logRotateDaily = True   ### <-- ENTER False TO ONLY ROTATE THE LOG ON SIZE ###
+logGenerations = 30     ### <-- ENTER NUMBER OF COMPRESSED LOGS TO KEEP ###
+
+# Initialize QR Code Struct, Line and Quantity are integers
 class QRCode(object):
+    __slots__ = ('PurchaseOrder', 'ItemNumber', 'Line', 'Quantity')
+
     def __init__(self, PO, IN, L, Q):
         self.PurchaseOrder = PO
         self.ItemNumber = IN
         self.Line = L
         self.Quantity = Q
+
+    def __eq__(self, other):
+        return isinstance(other, QRCode) and self.fields() == other.fields()
+
+    def __repr__(self):
+        return 'QRCode' + repr(self.fields())
+
+    def fields(self):
+        return (self.PurchaseOrder, self.ItemNumber, self.Line, self.Quantity)
+
+# Raised for a scan that isn't a valid QR code
+class ScanFormatError(ValueError):
+    pass
+
+# Raised for a valid scan that must not be entered
+class ScanRejected(Exception):
+    pass
      
         
+####################
+#   SCAN READER    #
+####################
+
+# Buffers raw scanner bytes and splits them into whole scans on a
+# terminator byte, or on an inter-byte gap for scanners that send none.
+# Only the newly fed bytes are searched, so the cost of handling a scan
+# does not grow with whatever is still buffered.
+class FrameAssembler(object):
+    def __init__(self, terminators=scanTerminators, gapTimeout=scanGapTimeout,
+                 maxLength=maxScanLength, maxFrames=maxPendingScans):
+        self.pattern = re.compile(b'[' + re.escape(terminators) + b']')
+        self.gapTimeout = gapTimeout
+        self.maxLength = maxLength
+        self.buffer = bytearray()
+        self.frames = collections.deque(maxlen=maxFrames)
+        self.lastByte = 0.0
+        self.dropped = 0
+
+    # Add &chunk to the buffer and queue every scan it completes
+    def feed(self, chunk, now=None):
+        view = memoryview(chunk)
+        start = 0
+        for match in self.pattern.finditer(chunk):
+            self.buffer += view[start:match.start()]
+            self.flush()
+            start = match.end()
+        self.buffer += view[start:]
+        if len(self.buffer) > self.maxLength:
+            printLog('SCAN DISCARDED: over ' + str(self.maxLength) + ' bytes')
+            self.buffer.clear()
+            self.dropped += 1
+        self.lastByte = time.monotonic() if now is None else now
+
+    # Queue the buffered bytes as a whole scan, skipping empty frames
+    def flush(self):
+        if len(self.buffer) > 0:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1 # deque drops the oldest scan
+            self.frames.append(bytes(self.buffer))
+            self.buffer.clear()
+
+    # Flush a partial scan once the line has been quiet for the gap timeout
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if len(self.buffer) > 0 and now - self.lastByte >= self.gapTimeout:
+            self.flush()
+
+    # True while part of a scan is waiting for its terminator
+    def pending(self):
+        return len(self.buffer) > 0
+
+    # Return the oldest whole scan, or None if there isn't one
+    def popFrame(self):
+        if len(self.frames) > 0:
+            return self.frames.popleft()
+        return None
+
+# Waits on the scanner port with blocking reads instead of polling it.
+# The port timeout doubles as an idle wake-up so callers can run idle
+# handlers and enforce their own timeouts while no one is scanning.
+class ScanReader(object):
+    def __init__(self, ser, idleTimeout=readTimeout, assembler=None):
+        self.ser = ser
+        self.ser.timeout = idleTimeout
+        self.idleTimeout = idleTimeout
+        self.assembler = assembler or FrameAssembler()
+        self.idleHandlers = []
+
+    # Register &handler to be called each time the reader wakes up idle
+    def onIdle(self, handler):
+        self.idleHandlers.append(handler)
+
+    # Block for up to &timeout seconds and return whatever bytes arrived
+    def readChunk(self, timeout):
+        if self.ser.timeout != timeout:
+            self.ser.timeout = timeout
+        data = self.ser.read(1) # sleeps in the driver until data or timeout
+        if len(data) > 0:
+            waiting = self.ser.in_waiting
+            if waiting > 0:
+                data += self.ser.read(waiting)
+        return data
+
+    # Return the next whole scan, or b'' after &timeout seconds
+    def readScan(self, timeout=None):
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            frame = self.assembler.popFrame()
+            if frame is not None:
+                return frame
+
+            # Part of a scan is buffered, wait one gap for the rest of it
+            if self.assembler.pending():
+                data = self.readChunk(self.assembler.gapTimeout)
+                if len(data) > 0:
+                    self.assembler.feed(data)
+                else:
+                    self.assembler.flush()
+                continue
+
+            data = self.readChunk(self.idleTimeout)
+            if len(data) > 0:
+                self.assembler.feed(data)
+                continue
+            for handler in self.idleHandlers:
+                handler()
+            if timeout is not None and time.monotonic() >= deadline:
+                return b''
+
+    def close(self):
+        self.ser.close()
+
+# Reads the scanner on a dedicated thread into a bounded queue so the
+# operator can scan ahead while the keyboard automation is still typing.
+# When the queue is full &policy decides what happens to the new scan:
+#   'block'      - stop reading and let the OS buffer hold further scans
+#   'dropOldest' - discard the oldest queued scan to make room
+#   'beep'       - sound the bell, log and discard the new scan
+class ScanPump(object):
+    def __init__(self, reader, maxScans=scanQueueSize, policy=backpressure):
+        if policy not in ('block', 'dropOldest', 'beep'):
+            raise ValueError('Unknown backpressure policy: ' + str(policy))
+        self.reader = reader
+        self.policy = policy
+        self.scans = queue.Queue(maxScans)
+        self.stopped = threading.Event()
+        self.error = None
+        self.dropped = 0
+        self.pending = None
+        self.notify = None # called from the reader thread after each queued scan
+        self.thread = threading.Thread(target=self.run, name='ScanPump', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    # Reader thread - wakes once per idle period to check for stop
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                frame = self.reader.readScan(self.reader.idleTimeout)
+                if len(frame) > 0:
+                    self.put(frame)
+        except (OSError, serial.SerialException) as e:
+            self.error = e
+            printLog('SCANNER READ FAILED: ' + str(e))
+
+    # Queue &frame according to the backpressure policy
+    def put(self, frame):
+        self.enqueue(frame)
+        if self.notify is not None:
+            self.notify()
+
+    def enqueue(self, frame):
+        if self.policy == 'block':
+            while not self.stopped.is_set():
+                try:
+                    self.scans.put(frame, timeout=self.reader.idleTimeout)
+                    return
+                except queue.Full:
+                    continue
+        elif self.policy == 'dropOldest':
+            while True:
+                try:
+                    self.scans.put_nowait(frame)
+                    return
+                except queue.Full:
+                    try:
+                        self.scans.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        else:
+            try:
+                self.scans.put_nowait(frame)
+            except queue.Full:
+                self.dropped += 1
+                sys.__stdout__.write('\a')
+                sys.__stdout__.flush()
+                printLog('SCAN QUEUE FULL, SCAN DISCARDED - WAIT FOR TYPING TO FINISH')
+
+    # Block until a scan is queued without consuming it
+    def waitScan(self):
+        if self.pending is None:
+            self.pending = self.readScan()
+
+    # Return the next queued scan, or b'' after &timeout seconds
+    def readScan(self, timeout=None):
+        if self.pending is not None:
+            frame, self.pending = self.pending, None
+            return frame
+        wait = self.reader.idleTimeout if timeout is None else timeout
+        while True:
+            try:
+                return self.scans.get(timeout=wait)
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+                if timeout is not None:
+                    return b''
+
+    def close(self):
+        self.stop()
+        self.thread.join(self.reader.idleTimeout * 2)
+        self.reader.close()
+
+# Trailing bytes stripped from every scan and control bytes dropped inside it.
+# GS is kept because GS1 barcodes use it as the FNC1 field separator.
+trailingBytes = scanTerminators + b'\r\n\x03\x04'
+controlBytes = bytes(b for b in range(32) if b != 0x1d) + b'\x7f'
+controlPattern = re.compile(b'[' + re.escape(controlBytes) + b']')
+
+# Decode a whole scan from raw bytes into text ready for typing
+def decodeScan(frame, encoding=scanEncoding):
+
+    data = bytes(frame).rstrip(trailingBytes)
+
+    # Only copy the scan again if it actually holds control bytes
+    if controlPattern.search(data) is not None:
+        data = data.translate(None, controlBytes)
+
+    # A leading GS is the GS1 FNC1 start character. It stays as it is, so
+    # parseScan still picks the GS1 parser, and only separators are replaced
+    text = data.decode(encoding, 'replace')
+    if fnc1Separator != '\x1d':
+        text = text[:1] + text[1:].replace('\x1d', fnc1Separator)
+    return text
+
+####################
+# OUTPUT BACKENDS  #
+####################
+
+# Where keystrokes go. Keys are characters or pynput Key names such as
+# 'tab' and 'shift_r', a chord holds every key until the last is pressed
+class OutputBackend(object):
+    def press(self, key):
+        raise NotImplementedError
+
+    def release(self, key):
+        raise NotImplementedError
+
+    def type(self, text):
+        raise NotImplementedError
+
+    def chord(self, *keys):
+        for key in keys:
+            self.press(key)
+        for key in reversed(keys):
+            self.release(key)
+
+    # Change Oracle windows with Alt + W then window number &num, paced
+    # like any other macro. Macros do it with a '>num' step, so a backend
+    # that can focus windows itself only has to override this
+    def switchWindow(self, num):
+        sendMacro(self, compileMacro(('alt+w', str(num), '~window')))
+
+# Sends keystrokes to the foreground window through pynput
+class PynputBackend(OutputBackend):
+    def __init__(self, controller=None):
+        if Controller is None:
+            raise ImportError('pynput is needed to send keystrokes, use the recorder or null backend')
+        self.controller = controller or Controller()
+        self.keys = {key.name:key for key in Key}
+        self.type = self.controller.type
+
+    def press(self, key):
+        self.controller.press(self.keys.get(key, key))
+
+    def release(self, key):
+        self.controller.release(self.keys.get(key, key))
+
+# Keeps every event as ('press' | 'release' | 'type', value), in order
+class RecorderBackend(OutputBackend):
+    def __init__(self):
+        self.events = []
+
+    def press(self, key):
+        self.events.append(('press', key))
+
+    def release(self, key):
+        self.events.append(('release', key))
+
+    def type(self, text):
+        self.events.append(('type', text))
+
+    # Return and forget the events so far
+    def take(self):
+        events, self.events = self.events, []
+        return events
+
+# Drops every keystroke
+class NullBackend(OutputBackend):
+    def press(self, key):
+        pass
+
+    def release(self, key):
+        pass
+
+    def type(self, text):
+        pass
+
+outputBackends = {
+    'pynput':PynputBackend,
+    'recorder':RecorderBackend,
+    'null':NullBackend,
+    }
+
+####################
+# LATENCY TRACING  #
+####################
+
+# Ring buffer of timing spans, (scan, port, stage, start, duration) with
+# perf_counter_ns times. A scan number is taken each time nextScan returns,
+# and every span its session records until the next one belongs to it
+class ScanTrace(object):
+    def __init__(self, size=traceSize):
+        self.spans = collections.deque(maxlen=size)
+        self.scans = 0
+        self.current = threading.local()
+        self.lock = threading.Lock()
+        self.epoch = (time.time(), time.perf_counter_ns())
+
+    def span(self, stage, start, end):
+        if stage == 'nextScan':
+            with self.lock:
+                self.scans += 1
+                self.current.scan = self.scans
+        self.spans.append((getattr(self.current, 'scan', 0), getattr(sessionInfo, 'port', None),
+                           stage, start, end - start))
+
+    # Write every span to JSONL file &fname, log each stage's percentiles
+    # unless &summary is False and return the number of spans written
+    def dump(self, fname, summary=True):
+
+        spans = list(self.spans)
+        wall, base = self.epoch
+        with open(fname, 'w') as out:
+            for scan, port, stage, start, duration in spans:
+                out.write(json.dumps({
+                    'scan':scan,
+                    'port':port,
+                    'stage':stage,
+                    'time':datetime.datetime.fromtimestamp(wall + (start - base) / pow(10, 9)).isoformat(),
+                    'ms':duration / pow(10, 6),
+                    }) + '\n')
+        if not summary:
+            return len(spans)
+
+        stages = collections.defaultdict(list)
+        for scan, port, stage, start, duration in spans:
+            stages[stage].append(duration / pow(10, 6))
+        for stage, times in sorted(stages.items()):
+            times.sort()
+            printLog('%-20s %6d spans  p50 %8.2fms  p95 %8.2fms  max %8.2fms'
+                     % (stage, len(times), times[len(times) // 2],
+                        times[min(len(times) - 1, len(times) * 95 // 100)], times[-1]))
+        return len(spans)
+
+# Timing spans once tracing is on, None turns it off
+scanTrace = None
+
+# Decorator recording a span for &stage around each call while tracing is
+# on. When it is off a call costs one global lookup more
+def traced(stage):
+    def wrap(function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            trace = scanTrace
+            if trace is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                trace.span(stage, start, time.perf_counter_ns())
+        return timed
+    return wrap
+
+####################
+#      PACING      #
+####################
+
+# Reads the title of the foreground window, where the platform allows it
+class WindowWatcher(object):
+    def __init__(self):
+        try:
+            import ctypes
+            self.ctypes = ctypes
+            self.user32 = ctypes.windll.user32
+        except (ImportError, AttributeError):
+            self.user32 = None
+
+    # Return the foreground window title, or None if it can't be read
+    def title(self):
+        if self.user32 is None:
+            return None
+        window = self.user32.GetForegroundWindow()
+        length = self.user32.GetWindowTextLengthW(window)
+        text = self.ctypes.create_unicode_buffer(length + 1)
+        self.user32.GetWindowTextW(window, text, length + 1)
+        return text.value
+
+# Spaces keystrokes to match how fast the target application keeps up.
+# Every step of &profile is scaled by one factor, which shrinks each time
+# Oracle changes windows within the expected time and doubles when it
+# changes them late. A title that stays put for &staleLimit waits in a row
+# says nothing about Oracle, so the base profile is slept as it is until
+# the title changes again. Without a window title to watch, the scaled
+# delays are slept as they are.
+class Pacer(object):
+    def __init__(self, profile=pacingProfile, watcher=None,
+                 minScale=0.1, maxScale=8.0, pollInterval=0.01, staleLimit=3):
+        self.profile = profile
+        self.watcher = watcher or WindowWatcher()
+        self.scale = 1.0
+        self.minScale = minScale
+        self.maxScale = maxScale
+        self.pollInterval = pollInterval
+        self.staleLimit = staleLimit
+        self.stale = 0
+        self.lastTitle = None
+
+    # Note the current window before a macro is sent
+    def begin(self):
+        self.lastTitle = self.watcher.title()
+
+    # Delay after a macro step of class &step
+    def pace(self, step):
+        delay = self.profile.get(step, 0.0) * self.scale
+        if delay > 0:
+            time.sleep(delay)
+
+    # Wait for the window to change after a &step that should change it
+    @traced('windowWait')
+    def wait(self, step):
+
+        expected = self.profile.get(step, 0.0) * self.scale
+        if self.lastTitle is None:
+            if expected > 0:
+                time.sleep(expected)
+            return
+
+        # The title isn't changing, sleep the base delay and look once
+        if self.stale >= self.staleLimit:
+            time.sleep(self.profile.get(step, 0.0))
+            title = self.watcher.title()
+            if title != self.lastTitle:
+                self.stale = 0
+                printLog('WINDOW TITLE CHANGING AGAIN, ADAPTIVE PACING RESUMED')
+            self.lastTitle = title
+            return
+
+        start = time.monotonic()
+        title = self.watcher.title()
+        while title == self.lastTitle and time.monotonic() - start < windowTimeout:
+            time.sleep(self.pollInterval)
+            title = self.watcher.title()
+        elapsed = time.monotonic() - start
+        changed = title != self.lastTitle
+        self.lastTitle = title
+
+        # Timing out without a change is no signal, Oracle may never retitle this window
+        if not changed:
+            self.stale += 1
+            if self.stale >= self.staleLimit:
+                self.scale = 1.0
+                printLog('WINDOW TITLE NOT CHANGING, PACING WITH BASE DELAYS')
+            return
+        self.stale = 0
+
+        # Shrink delays while Oracle keeps up, back off when it lags
+        if elapsed <= expected:
+            self.scale = max(self.minScale, self.scale * 0.9)
+        else:
+            self.scale = min(self.maxScale, self.scale * 2)
+            printLog('ORACLE SLOW TO RESPOND (' + str(round(elapsed, 2)) + 's), SLOWING KEYSTROKES')
+
+# Keystroke pacer shared by every macro, None sends without delays
+pacer = None
+
+####################
+#     LOGGING      #
+####################
+
+# Archives the log file once it grows past &maxSize bytes or, with &daily,
+# once the date changes. Archives are named by the time they were rotated,
+# gzipped on a background thread, and only the newest &generations kept.
+class LogRotator(object):
+    def __init__(self, fname, maxSize=logMaxSize * pow(10, 6),
+                 daily=logRotateDaily, generations=logGenerations):
+        self.fname = fname
+        self.directory = os.path.dirname(fname) or '.'
+        self.base, self.ext = os.path.splitext(os.path.basename(fname))
+        self.maxSize = maxSize
+        self.daily = daily
+        self.generations = generations
+        self.day = None
+        self.compressors = []
+        self.compressing = set()
+
+    # Open the log file for appending, rotating it first if it is due.
+    # Returns the file and its current size
+    def open(self):
+        size = fileSize(self.fname)
+        if size > 0:
+            self.day = time.strftime('%Y%m%d', time.localtime(os.stat(self.fname).st_mtime))
+            if self.due(size):
+                self.archive()
+                size = 0
+        self.day = time.strftime('%Y%m%d')
+        return open(self.fname, 'a'), size
+
+    # True once a log of &size bytes should be rotated
+    def due(self, size):
+        return size >= self.maxSize or (self.daily and time.strftime('%Y%m%d') != self.day)
+
+    # Close &stream, archive it and return the newly opened log and its size
+    def rotate(self, stream):
+        stream.close()
+        self.archive()
+        return self.open()
+
+    # Rename the log to a timestamped archive and compress it in the background
+    def archive(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        count = 0
+        while True:
+            path = os.path.join(self.directory, '%s.%s-%03d%s' % (self.base, stamp, count, self.ext))
+            if not os.path.exists(path) and not os.path.exists(path + '.gz'):
+                break
+            count += 1
+        os.rename(self.fname, path)
+        self.startCompressor(path)
+
+    def startCompressor(self, path):
+        self.compressing.add(path)
+        compressor = threading.Thread(target=self.compress, args=(path,), name='LogCompressor', daemon=True)
+        self.compressors = [thread for thread in self.compressors if thread.is_alive()]
+        self.compressors.append(compressor)
+        compressor.start()
+
+    # Compressor thread - gzip &path, remove it and prune old archives
+    def compress(self, path):
+        try:
+            with open(path, 'rb') as source, gzip.open(path + '.partial', 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            os.replace(path + '.partial', path + '.gz')
+            os.remove(path)
+            self.prune()
+        except OSError as e:
+            sys.__stderr__.write('UNABLE TO COMPRESS LOG ' + path + ': ' + repr(e) + '\n')
+        finally:
+            self.compressing.discard(path)
+
+    # Archive names sorted oldest first, optionally with &suffix appended
+    def archives(self, suffix=''):
+        prefix = self.base + '.'
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.startswith(prefix) and name.endswith(self.ext + suffix)
+                      and name != os.path.basename(self.fname))
+
+    # Delete all but the newest compressed archives
+    def prune(self):
+        archives = self.archives('.gz')
+        for path in archives[:max(0, len(archives) - self.generations)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # pruned by another compressor
+
+    # Compress archives an earlier run exited before compressing
+    def compressLeftovers(self):
+        for path in self.archives():
+            if path not in self.compressing and not os.path.exists(path + '.gz'):
+                self.startCompressor(path)
+
+    # Wait for background compression to finish
+    def join(self):
+        for thread in self.compressors:
+            thread.join()
+
+# Writes log lines to the log file on a dedicated thread. Lines are written
+# as they arrive but only flushed to disk every &flushInterval seconds or
+# &flushLines lines, so scanning and typing never wait on the disk.
+# With a &rotator, the size is tracked as lines are written and the log is
+# rotated mid-run rather than only at startup.
+class LogWriter(object):
+    def __init__(self, stream, rotator=None, size=0,
+                 flushInterval=logFlushInterval, flushLines=logFlushLines):
+        self.stream = stream
+        self.rotator = rotator
+        self.size = size
+        self.flushInterval = flushInterval
+        self.flushLines = flushLines
+        self.lines = queue.SimpleQueue()
+        self.stop = object()
+        self.check = object()
+        self.thread = threading.Thread(target=self.run, name='LogWriter', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    # Queue &line for writing
+    def write(self, line):
+        self.lines.put(line)
+
+    # Writer thread
+    def run(self):
+
+        unflushed = 0
+        deadline = None
+        while True:
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.lines.get(timeout=wait)
+            except queue.Empty:
+                item = None
+
+            try:
+                if isinstance(item, str):
+                    self.stream.write(item)
+                    self.size += len(item)
+                    unflushed += 1
+                    if self.rotator is not None and self.rotator.due(self.size):
+                        self.stream, self.size = self.rotator.rotate(self.stream)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flushInterval
+                    if unflushed < self.flushLines:
+                        continue
+                elif item is self.check and self.rotator is not None and self.rotator.due(self.size):
+                    self.stream, self.size = self.rotator.rotate(self.stream)
+                self.stream.flush()
+            except (OSError, ValueError) as e:
+                sys.__stderr__.write('UNABLE TO WRITE LOG: ' + repr(e) + '\n')
+            unflushed = 0
+            deadline = None
+
+            # Flush requests and stop arrive as queue items
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is self.stop:
+                return
+
+    # Flush and rotate the log if it is due, without waiting. Daily rotation
+    # otherwise waits for the next line written
+    def maintain(self):
+        self.lines.put(self.check)
+
+    # Block until every line queued so far is on disk
+    def flush(self):
+        if self.thread.is_alive():
+            done = threading.Event()
+            self.lines.put(done)
+            done.wait(5.0)
+
+    # Flush and stop the writer thread
+    def close(self):
+        if self.thread.is_alive():
+            self.lines.put(self.stop)
+            self.thread.join(5.0)
+        if self.rotator is not None:
+            self.rotator.join()
+
+# Log writer once the log file is open, until then printLog prints directly
+logWriter = None
+
+# Timestamp prefix for log lines, rebuilt at most once per second
+logStamp = (0, '')
+
+# Return the log line prefix for the current second
+def timeStamp():
+
+    global logStamp
+    now = int(time.time())
+    stamp = logStamp
+    if stamp[0] != now:
+        stamp = logStamp = (now, time.strftime('%Y-%m-%d %H:%M:%S : ', time.localtime(now)))
+    return stamp[1]
+
+# Flush every queued log line to disk
+def flushLog():
+    if logWriter is not None:
+        logWriter.flush()
+    else:
+        sys.stdout.flush()
+
+# Flush the log and rotate it if due, without blocking the caller
+def maintainLog():
+    if logWriter is not None:
+        logWriter.maintain()
+
+# Flush and close the log writer, also run at exit in case of a crash
+def closeLog():
+    if logWriter is not None:
+        logWriter.close()
+
+atexit.register(closeLog)
+
+####################
+#   SCAN JOURNAL   #
+####################
+
+# Append-only JSONL journal of every parsed QR code and what became of it.
+# A small tab separated index beside it maps each PO and item number to
+# the offsets of its records, so log_query --journal seeks straight to
+# them instead of reading the whole journal. The utility only appends to
+# the index. If it falls behind after a crash, the journal is indexed again
+# from the last record the index holds when it is opened.
+class ScanJournal(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.indexName = os.path.splitext(fname)[0] + '.idx'
+        self.lock = threading.Lock()
+        self.catchUp()
+        self.journal = open(self.fname, 'ab')
+        self.indexFile = open(self.indexName, 'a')
+
+    # (offset, kind) of the last complete line of the index, reading only
+    # its tail. (None, None) if it has none
+    def lastIndexed(self, tail=4096):
+
+        if not os.path.exists(self.indexName):
+            return None, None
+        with open(self.indexName, 'rb') as index:
+            index.seek(max(0, os.stat(self.indexName).st_size - tail))
+            lines = index.read().split(b'\n')
+        for line in reversed(lines[:-1]):
+            fields = line.decode('utf-8', 'replace').split('\t')
+            if len(fields) == 3 and fields[0] in ('P', 'I') and fields[2].isdigit():
+                return int(fields[2]), fields[0]
+        return None, None
+
+    # Index any journal records written after the index was last appended to
+    def catchUp(self):
+
+        if not os.path.exists(self.fname):
+            return
+        offset, kind = self.lastIndexed()
+        with open(self.fname, 'rb') as journal, open(self.indexName, 'ab+') as index:
+            if index.tell() > 0:
+                index.seek(-1, os.SEEK_END)
+                if index.read(1) != b'\n':
+                    index.write(b'\n') # finish a line cut short by a crash
+
+            # The item line is written last, without it the record is indexed again
+            if offset is not None:
+                journal.seek(offset)
+                if kind == 'I':
+                    journal.readline()
+            while True:
+                offset = journal.tell()
+                line = journal.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                index.write(self.indexLines(record, offset).encode('utf-8'))
+
+    # Index lines for &record at &offset
+    @staticmethod
+    def indexLines(record, offset):
+        lines = ''
+        for kind, field in (('P', 'PO'), ('I', 'item')):
+            key = str(record.get(field, '')).replace('\t', ' ').replace('\n', ' ')
+            lines += kind + '\t' + key + '\t' + str(offset) + '\n'
+        return lines
+
+    # Append &QR with the &mode it was scanned in and its &outcome
+    def record(self, QR, mode, outcome):
+        record = {
+            'time':timeStamp()[:19],
+            'PO':QR.PurchaseOrder,
+            'item':QR.ItemNumber,
+            'line':QR.Line,
+            'quantity':QR.Quantity,
+            'mode':mode,
+            'outcome':outcome,
+            }
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self.lock:
+            offset = self.journal.tell()
+            self.journal.write(line)
+            self.journal.flush() # journal first, so the index never points past it
+            self.indexFile.write(self.indexLines(record, offset))
+            self.indexFile.flush()
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
+            self.indexFile.close()
+
+# Scan journal once it is open
+scanJournal = None
+
+# Journal &QR from &workflow if the journal is open
+def journalScan(QR, workflow, outcome):
+    if scanJournal is not None and QR is not None:
+        try:
+            scanJournal.record(QR, workflow, outcome)
+        except OSError as e:
+            printLog('UNABLE TO WRITE SCAN JOURNAL: ' + repr(e))
+
+####################
+# DUPLICATE SCANS  #
+####################
+
+# Recently processed scans with the time each was entered. Entries expire
+# after &ttl seconds and the least recently used are evicted past &maxSize.
+# With &fname, entries are appended to that file and reloaded on restart.
+class ScanCache(object):
+    def __init__(self, ttl=dedupeTTL, maxSize=dedupeSize, fname=None):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.file = None
+        if fname is not None:
+            self.load(fname)
+            self.file = open(fname, 'a')
+
+    # Load unexpired entries from &fname, then rewrite it without the rest
+    def load(self, fname):
+
+        now = time.time()
+        if os.path.exists(fname):
+            with open(fname) as cache:
+                for line in cache:
+                    stamp, _, key = line.rstrip('\n').partition('\t')
+                    try:
+                        stamp, key = float(stamp), json.loads(key)
+                    except ValueError:
+                        continue
+                    if now - stamp < self.ttl:
+                        self.entries[key] = stamp
+                        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+        with open(fname + '.new', 'w') as cache:
+            for key, stamp in self.entries.items():
+                cache.write('%.0f\t%s\n' % (stamp, json.dumps(key)))
+        os.replace(fname + '.new', fname)
+
+    # Return when &key was entered if that was within the TTL, otherwise None
+    def seen(self, key):
+        with self.lock:
+            stamp = self.entries.get(key)
+            if stamp is None:
+                return None
+            if time.time() - stamp >= self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return stamp
+
+    # Remember &key as entered now
+    def add(self, key):
+        stamp = time.time()
+        with self.lock:
+            self.entries[key] = stamp
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+            if self.file is not None:
+                self.file.write('%.0f\t%s\n' % (stamp, json.dumps(key)))
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# Duplicate scan cache once it is set up, None turns the check off
+scanCache = None
+
+# Raise ScanRejected if &data was already entered by this workflow within
+# the TTL, unless the override was scanned first. Returns the cache key
+def checkDuplicate(context, data):
+
+    if scanCache is None:
+        return None
+    key = context.workflow + '\t' + data
+    if context.override:
+        context.override = False
+    else:
+        stamp = scanCache.seen(key)
+        if stamp is not None:
+            raise ScanRejected('DUPLICATE SCAN, already entered at '
+                               + time.strftime('%H:%M:%S', time.localtime(stamp))
+                               + '. Scan \'' + overrideScan + '\' first to enter it again')
+    return key
+
+# Remember a scan checkDuplicate accepted, once it has been saved in Oracle.
+# A workflow dropped before then can scan the same label again
+def rememberScan(key):
+    if key is not None:
+        scanCache.add(key)
+
+# Allow the next scan in this workflow even if it is a duplicate
+def armOverride(keyboard, context, data):
+    context.override = True
+    printLog('Duplicate check overridden for the next scan')
+
+####################
+#   MASTER DATA    #
+####################
+
+# Open PO lines exported from Oracle, as a CSV with PO, Item and Line
+# columns or a SQLite database with an open_lines(po, item, line) table.
+# Every lookup is a set membership test. The export is reloaded when its
+# modification time changes, checked at most every &checkInterval seconds.
+class MasterData(object):
+    def __init__(self, fname, checkInterval=masterDataCheck):
+        self.fname = fname
+        self.checkInterval = checkInterval
+        self.mtime = None
+        self.checked = 0.0
+        self.index = None
+        self.lock = threading.Lock()
+
+    # Reload the export if it changed since it was last read
+    def refresh(self):
+
+        now = time.monotonic()
+        with self.lock:
+            if self.index is not None and now - self.checked < self.checkInterval:
+                return
+            self.checked = now
+            try:
+                mtime = os.stat(self.fname).st_mtime
+            except OSError:
+                if self.mtime is not None or self.index is None:
+                    printLog('OPEN LINE EXPORT NOT FOUND: ' + self.fname)
+                self.mtime, self.index = None, ()
+                return
+            if mtime == self.mtime:
+                return
+            try:
+                self.index = self.load()
+                self.mtime = mtime
+                printLog('Loaded ' + str(len(self.index[2])) + ' open PO lines from ' + self.fname)
+            except (IOError, ValueError, KeyError, sqlite3.Error) as e:
+                printLog('UNABLE TO LOAD OPEN LINE EXPORT: ' + repr(e))
+                if self.index is None:
+                    self.index = ()
+
+    # Read every open line and return (POs, (PO, item), (PO, item, line)) sets
+    def load(self):
+
+        if self.fname.lower().endswith('.csv'):
+            with open(self.fname, newline='') as export:
+                rows = [(row['PO'], row['Item'], row['Line']) for row in csv.DictReader(export)]
+        else:
+            connection = sqlite3.connect('file:' + self.fname + '?mode=ro', uri=True)
+            try:
+                rows = connection.execute('SELECT po, item, line FROM open_lines').fetchall()
+            finally:
+                connection.close()
+
+        lines = set((str(PO).strip(), str(IN).strip(), int(L)) for PO, IN, L in rows)
+        return (set(PO for PO, IN, L in lines), set((PO, IN) for PO, IN, L in lines), lines)
+
+    # Return why &QR isn't an open line, or None if it is or nothing is loaded.
+    # GS1 and JSON labels may leave the line out, parsed as 0, and then only
+    # the item has to be open on the PO
+    def check(self, QR):
+
+        self.refresh()
+        if not self.index:
+            return None
+        POs, items, lines = self.index
+        if (QR.PurchaseOrder, QR.ItemNumber, QR.Line) in lines:
+            return None
+        if QR.Line == 0 and (QR.PurchaseOrder, QR.ItemNumber) in items:
+            return None
+        if QR.PurchaseOrder not in POs:
+            return 'PO ' + str(QR.PurchaseOrder) + ' is not open'
+        if (QR.PurchaseOrder, QR.ItemNumber) not in items:
+            return 'item ' + str(QR.ItemNumber) + ' is not open on PO ' + str(QR.PurchaseOrder)
+        return ('line ' + str(QR.Line) + ' of PO ' + str(QR.PurchaseOrder)
+                + ' is not open for item ' + str(QR.ItemNumber))
+
+# Open line export once it is set up, None turns the check off
+masterData = None
+
+# Refuse &QR if it isn't an open line, or only log it with the 'flag' policy
+def checkOpenLine(QR):
+
+    if masterData is None:
+        return
+    reason = masterData.check(QR)
+    if reason is not None:
+        if masterDataPolicy == 'flag':
+            printLog('NOT AN OPEN LINE, entering anyway: ' + reason)
+        else:
+            raise ScanRejected('NOT AN OPEN LINE: ' + reason)
+
+####################
+#  OFFLINE QUEUE   #
+####################
+
+# Receipts scanned while Oracle can't take keystrokes, kept in a SQLite
+# database until they are replayed. Each receipt moves from 'queued' to
+# 'started' just before its keystrokes are sent and to 'done' or
+# 'rejected' after, every change committed, so a replay that crashes
+# picks up where it stopped. A receipt left 'started' may already be in
+# Oracle, so it is 'held' for the operator to check instead of sent again.
+class ScanQueue(object):
+    def __init__(self, fname):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(fname, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS receipts ('
+                                'id INTEGER PRIMARY KEY, queued REAL, scan TEXT, '
+                                'subinventory TEXT, status TEXT, replayed REAL)')
+        self.connection.commit()
+
+    # Queue receipt &scan with its &subinventory answer, returns its id
+    def add(self, scan, subinventory):
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT INTO receipts (queued, scan, subinventory, status) VALUES (?, ?, ?, ?)',
+                (time.time(), scan, subinventory, 'queued'))
+            self.connection.commit()
+            return cursor.lastrowid
+
+    # Receipts still to replay, oldest first, as (id, scan, subinventory, status)
+    def pending(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT id, scan, subinventory, status FROM receipts '
+                'WHERE status IN (\'queued\', \'started\') ORDER BY id').fetchall()
+
+    def mark(self, id, status):
+        with self.lock:
+            self.connection.execute('UPDATE receipts SET status = ?, replayed = ? WHERE id = ?',
+                                    (status, time.time(), id))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# Offline queue once it is set up, None turns offline mode off
+scanQueue = None
+
+####################
+# PAYLOAD FORMATS  #
+####################
+
+# Parsers for QR payloads other than PO#IN#L#Q, keyed by first character
+payloadFormats = {}
+
+# Decorator registering a parser for payloads starting with any of &firsts
+def registerFormat(*firsts):
+    def register(parser):
+        for first in firsts:
+            payloadFormats[first] = parser
+        return parser
+    return register
+
+# Parse a scanned payload of any registered format into a QRCode. The
+# format is picked by one lookup on the first character, and everything
+# unclaimed goes straight to separateQR, so PO#IN#L#Q pays nothing extra
+@traced('parseScan')
+def parseScan(data):
+    parser = payloadFormats.get(data[:1])
+    if parser is None:
+        return parseDelimited(data)
+    return parser(data)
+
+# True if &data looks like a QR payload of some registered format
+def isPayload(data):
+    return (data.count('#') == 3 or data[:1] in payloadFormats
+            or any(data.count(delimiter) == 3 for delimiter in delimiterVariants))
+
+# Build a QRCode from field values, checking them like separateQR does
+def buildQRCode(PO, IN, L, Q, data):
+
+    if not PO or not IN or Q is None:
+        raise ScanFormatError('missing PO, item or quantity in ' + repr(data))
+    # Parse the text of each value, so 2.5 and true aren't truncated to numbers
+    try:
+        L = int(str(L or 0))
+        Q = int(str(Q))
+    except (TypeError, ValueError):
+        raise ScanFormatError('line and quantity must be numbers, got ' + repr(data)) from None
+    if L < 0 or Q <= 0:
+        raise ScanFormatError('line or quantity out of range, got ' + repr(data))
+    return QRCode(str(PO), str(IN), L, Q)
+
+# PO#IN#L#Q, falling back to the same layout with another delimiter
+def parseDelimited(data):
+    try:
+        return separateQR(data)
+    except ScanFormatError:
+        for delimiter in delimiterVariants:
+            if data.count(delimiter) == 3 and '#' not in data:
+                return separateQR(data.replace(delimiter, '#'))
+        raise
+
+# JSON labels, e.g. {"PO":"12345","item":"ABC-1","line":1,"quantity":5}
+jsonKeys = {
+    'po':'PO', 'purchaseorder':'PO',
+    'in':'IN', 'item':'IN', 'itemnumber':'IN',
+    'l':'L', 'line':'L',
+    'q':'Q', 'qty':'Q', 'quantity':'Q',
+    }
+
+@registerFormat('{')
+def parseJSON(data):
+    try:
+        label = json.loads(data)
+    except ValueError as e:
+        raise ScanFormatError('invalid JSON label: ' + str(e)) from None
+    if not isinstance(label, dict):
+        raise ScanFormatError('JSON label must be an object, got ' + repr(data))
+    fields = {}
+    for key, value in label.items():
+        field = jsonKeys.get(str(key).lower())
+        if field is not None:
+            fields[field] = value
+    return buildQRCode(fields.get('PO'), fields.get('IN'), fields.get('L'), fields.get('Q'), data)
+
+# Total length (AI + data) of GS1 element strings with a predefined
+# length, by the first two digits of the AI. All others end at a GS.
+gs1FixedLengths = {
+    '00':20, '01':16, '02':16, '03':16, '04':18, '11':8, '12':8, '13':8,
+    '14':8, '15':8, '16':8, '17':8, '18':8, '19':8, '20':4, '31':10,
+    '32':10, '33':10, '34':10, '35':10, '36':10, '41':16,
+    }
+# Number of digits in the AI, by its first two digits (four if not listed)
+gs1AILengths = dict.fromkeys(('00', '01', '02', '03', '04', '10', '11', '12', '13', '15',
+                              '16', '17', '20', '21', '22', '30', '37')
+                             + tuple(str(n) for n in range(90, 100)), 2)
+gs1AILengths.update(dict.fromkeys(('23', '24', '25', '40', '41', '42'), 3))
+
+# Split GS1 element strings into {AI: value}. Accepts raw strings with GS
+# (or fnc1Separator) separators, an optional AIM symbology identifier such as ]C1 or ]d2,
+# and the human readable (AI)value form
+def splitGS1(data):
+
+    elements = {}
+    if data[:1] == '(':
+        for part in data[1:].split('('):
+            AI, _, value = part.partition(')')
+            elements[AI] = value
+        return elements
+
+    if data[:1] == ']':
+        data = data[3:]
+    data = data.lstrip('\x1d' + fnc1Separator)
+    pos = 0
+    while pos < len(data):
+        head = data[pos:pos + 2]
+        AI = data[pos:pos + gs1AILengths.get(head, 4)]
+        if not AI.isdigit():
+            raise ScanFormatError('invalid GS1 application identifier at ' + repr(data[pos:]))
+        fixed = gs1FixedLengths.get(head)
+        if fixed is not None:
+            end = pos + fixed
+            if end > len(data):
+                raise ScanFormatError('GS1 element ' + AI + ' is too short in ' + repr(data))
+        else:
+            end = data.find(fnc1Separator, pos)
+            if end < 0:
+                end = len(data)
+        elements[AI] = data[pos + len(AI):end]
+        pos = end + len(fnc1Separator) if data.startswith(fnc1Separator, end) else end
+    return elements
+
+@registerFormat(']', '(', '\x1d')
+def parseGS1(data):
+    elements = splitGS1(data)
+    fields = {}
+    for field, AIs in gs1Fields.items():
+        fields[field] = next((elements[AI] for AI in AIs if AI in elements), None)
+    return buildQRCode(fields['PO'], fields['IN'], fields['L'], fields['Q'], data)
+
 ####################
 #    FUNCTIONS     #
 ####################
 
-# Separates QR Code string of data and returns struct
-def separateQR(string):
-    PO,IN,L,Q = string.split("#")
-    return QRCode(PO,IN,L,Q)
+# Separates QR Code data (text, or raw scan bytes/bytearray) into its struct. Fields
+# are located by index rather than split out, so the only copies made are
+# the four field values. Raises ScanFormatError unless the data is exactly
+# PO#IN#L#Q with a whole-number line and a positive whole-number quantity
+@traced('separateQR')
+def separateQR(data):
+
+    sep = '#' if isinstance(data, str) else b'#'
+    first = data.find(sep)
+    second = data.find(sep, first + 1)
+    third = data.find(sep, second + 1)
+    if first <= 0 or second <= first + 1 or third < 0 or data.find(sep, third + 1) >= 0:
+        raise ScanFormatError('expected PO#IN#L#Q, got ' + repr(data))
 
-# Print string then flush ouput to the log file incase of improper exit
+    try:
+        L = int(data[second + 1:third])
+        Q = int(data[third + 1:])
+    except ValueError:
+        raise ScanFormatError('line and quantity must be numbers, got ' + repr(data)) from None
+    if L < 0 or Q <= 0:
+        raise ScanFormatError('line or quantity out of range, got ' + repr(data))
+
+    PO = data[:first]
+    IN = data[first + 1:second]
+    if sep == b'#':
+        PO = PO.decode(scanEncoding)
+        IN = IN.decode(scanEncoding)
+    return QRCode(PO, IN, L, Q)
+
+# Per-thread scanner session, used to tag log lines with the source port
+sessionInfo = threading.local()
+
+# Print string to the log file, the log writer flushes it shortly after
 def printLog(text):
 
     # Get Current Time
-    ts = time.time()
-    ds = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S : ')
+    ds = timeStamp()
     if text == '\n':
-        print(ds)
+        line = ds + '\n'
     else:
-        print(ds + text)
-    
-    # Flush the output
-    sys.stdout.flush()
-
-# Open Log File and replace it if size > Specified Size
-def openLogFile(user):
+        port = getattr(sessionInfo, 'port', None)
+        if port is not None:
+            ds = ds + '[' + port + '] '
+        line = ds + text + '\n'
 
-    maxSize = 100       ### <-- ENTER SIZE LIMIT IN MB HERE ###
+    if logWriter is not None:
+        logWriter.write(line)
+    else:
+        sys.stdout.write(line)
+        sys.stdout.flush()
 
-    maxSize = maxSize * pow(10, 6) # Convert to bytes
+# Folder holding the log and journal for &user
+def scannerFolder(user):
+    return 'C:\\Users\\' + user + '\\AppData\\Scanner\\'
 
-    fname = 'C:\\Users\\' + user + '\\AppData\\Scanner\\ReceivingLog.txt'
-    old = re.sub('.txt', 'Old.txt', fname)       
+# Open Log File for &user, rotating it if it is due, and start its writer
+def openLogFile(user):
 
-    if fileSize(fname) < maxSize:
-        return open(fname, 'a+') # Append log file
-    else:
-        # Archive old log and open new log
-        if os.path.exists(old):
-            os.remove(old) # Delete existing old log
-        if os.path.exists(fname):
-            os.rename(fname, old) # Rename current log to old
-        return open(fname, 'w+') # Write to new log
+    fname = scannerFolder(user) + 'ReceivingLog.txt'
+    rotator = LogRotator(fname)
+    stream, size = rotator.open()
+    rotator.compressLeftovers()
+    return LogWriter(stream, rotator, size).start()
     
 # Get File Size of &fname
 def fileSize(fname):
@@ -118,42 +1492,99 @@ def printFooter():
     printLog('*              Exiting script             * ')
     printLog('******************************************* \n\n')
 
+    # Make sure everything logged so far reaches the file
+    flushLog()
+
+# Keystroke event codes used by compiled macros
+PRESS, RELEASE, FIELD, PACE, WAIT, STAGE, SWITCH = 0, 1, 2, 3, 4, 5, 6
+
+# Compile a keystroke macro into a tuple of (code, key) events. Each step is
+#   'tab', 'enter', 'f4', ...  - press and release that Key name
+#   'r', '-', '4'              - press and release that character
+#   'ctrl+s', 'shift+tab'      - hold the modifiers around the last key
+#   'tab*7', 'shift+tab*2'     - repeat the step
+#   '{PO}'                     - type the value passed as field PO
+#   '~window'                  - wait for Oracle to change windows
+#   '>4'                       - change to Oracle window 4 through the backend
+#   '@quantity'                - end the timing span of that stage while tracing
+# Every step is followed by a pacing point for its class in pacingProfile.
+# Macros are cached per step sequence, so a workflow step is only parsed once
+@functools.lru_cache(maxsize=None)
+def compileMacro(steps):
+
+    events = []
+    for step in steps:
+        if step[:1] == '~':
+            events.append((WAIT, step[1:]))
+            continue
+        if step[:1] == '@':
+            events.append((STAGE, step[1:]))
+            continue
+        if step[:1] == '>':
+            events.append((SWITCH, int(step[1:])))
+            continue
+        if step[:1] == '{' and step[-1:] == '}':
+            events.append((FIELD, step[1:-1]))
+            events.append((PACE, 'type'))
+            continue
+        step, _, count = step.partition('*')
+        keys = step.split('+')
+        if Key is not None:
+            for key in keys:
+                if len(key) > 1:
+                    Key[key] # fail at compile time on a misspelt key name
+        pace = step if step in pacingProfile else 'key'
+        for _ in range(int(count or 1)):
+            for key in keys:
+                events.append((PRESS, key))
+            for key in reversed(keys):
+                events.append((RELEASE, key))
+            events.append((PACE, pace))
+    return tuple(events)
+
+# Send compiled &macro through OutputBackend &keyboard in one burst, typing &fields values
+def sendMacro(keyboard, macro, **fields):
+
+    press, release, typeText = keyboard.press, keyboard.release, keyboard.type
+    if pacer is not None:
+        pacer.begin()
+    trace = scanTrace
+    start = time.perf_counter_ns() if trace is not None else 0
+    for code, key in macro:
+        if code == PRESS:
+            press(key)
+        elif code == RELEASE:
+            release(key)
+        elif code == FIELD:
+            typeText(fields[key])
+        elif code == STAGE:
+            if trace is not None:
+                end = time.perf_counter_ns()
+                trace.span(key, start, end)
+                start = end
+        elif code == SWITCH:
+            keyboard.switchWindow(key)
+        elif pacer is None:
+            continue
+        elif code == PACE:
+            pacer.pace(key)
+        else:
+            pacer.wait(key)
+
 # Presses tab (positive number) and shift tab (negative number) &num times
 def pressTab(keyboard, num):
     if num > 0:
-        for _ in range(num): 
-            keyboard.press(Key.tab)
-            keyboard.release(Key.tab) 
-    else:
-        for _ in range(abs(num)):
-            with keyboard.pressed(Key.shift):
-                keyboard.press(Key.tab)
-                keyboard.release(Key.tab)
-
-# Presses Shift + Page_Down
-def shiftPgDn(keyboard):
-    keyboard.press(Key.shift)
-    keyboard.press(Key.shift_r)
-    keyboard.press(Key.page_down)
-    keyboard.release(Key.page_down)
-    keyboard.release(Key.shift_r)
-    keyboard.release(Key.shift)
-
-# Change Windows using Alt + W then window number &num
-def changeWindows(keyboard, num):
-    with keyboard.pressed(Key.alt):
-        keyboard.press('w')
-        keyboard.release('w')
-
-    keyboard.press(str(num))
-    keyboard.release(str(num))
-
-# Assign Scanner COM Port to serial
-def setupCOMPort():
-
-    port = checkPorts()
+        sendMacro(keyboard, compileMacro(('tab*' + str(num),)))
+    elif num < 0:
+        sendMacro(keyboard, compileMacro(('shift+tab*' + str(-num),)))
+
+# Assign Scanner COM Port &port (or the first matching port) to serial
+def setupCOMPort(port=None):
+
+    if port is None:
+        port = checkPorts()
     try:
-        ser = serial.Serial(port, 115200, timeout=0)
+        ser = serial.Serial(port, 115200, timeout=readTimeout)
     except OSError:
         printLog('SCANNER NOT FOUND ON PORT: ' + str(port))
         sys.exit()
@@ -162,26 +1593,35 @@ def setupCOMPort():
 # Iterate through open ports report COM Port that matches scanner description
 def checkPorts():
 
+    if scannerPort is not None:
+        return scannerPort
     ports = serial.tools.list_ports.comports()
     # Iterate over ports
     for port, desc, hwid in sorted(ports):
         # If description matches, report that port
-        if '##### BARCODE SCANNER DESCRIPTION TO MATCH #####' in desc:
+        if scannerDescription in desc:
             return port
     printLog('UNABLE TO LOCATE SCANNER. DEFAULTING TO COM3...')
     return 'COM3'
+
+# Report every COM Port that matches scanner description
+def checkAllPorts():
+
+    if scannerPort is not None:
+        return [scannerPort]
+    ports = serial.tools.list_ports.comports()
+    found = [port for port, desc, hwid in sorted(ports) if scannerDescription in desc]
+    if len(found) == 0:
+        found.append(checkPorts())
+    return found
             
-# Returns the next scanned data
-def nextScan(text, ser):
+# Returns the next scanned data, or an empty string if &timeout seconds pass
+@traced('nextScan')
+def nextScan(text, ser, timeout=None):
     
     printLog(text)
-    data = '' # Initialize data variable to an empty string
-    while len(data) == 0:
-        data = ser.read(9999) # get data from barcode scanner
-        if len(data) > 0:
-            data = str(data) # convert to string
-            data = data[2:len(data)-1] # remove prefix and suffix
-    return data
+    data = ser.readScan(timeout) # wait for data from barcode scanner
+    return decodeScan(data)
 
 # Checks for a mode change, returns a boolean
 def checkModeChange(data):
@@ -198,7 +1638,8 @@ def changeMode(data):
         # Trim prefix
         mode = data[8:]
         printLog('\n')
-        printLog('MODE CHANGED TO: ' + modes[mode])
+        handler = modeRegistry.get(mode)
+        printLog('MODE CHANGED TO: ' + (handler.label if handler else '\'' + mode + '\''))
         printLog('\n')
     else:
         mode = data
@@ -225,208 +1666,858 @@ def setDefaultMode(ser):
     return default
 
 # Enter &POvalue into Purchase Order Oracle Field then tab X times
+@traced('purchaseOrder')
 def purchaseOrder(keyboard, POvalue, numTabs):
-    
-    keyboard.type(POvalue) # Type Purchase Order
-    
-    # Press tab numTabs times
-    pressTab(keyboard, numTabs)
-        
+    sendMacro(keyboard, compileMacro(('{PO}', 'tab*' + str(numTabs))), PO=POvalue)
     printLog('Entered ' + str(POvalue) + ' into \'Purchase Order\' field')
 
 # Enter &INvalue into Item Number Oracle Field and hit enter
+@traced('itemNumber')
 def itemNumber(keyboard, INvalue):
-    
-    # Type Item Number and hit enter
-    keyboard.type(INvalue)
-    keyboard.press(Key.enter)
-    keyboard.release(Key.enter)
-    
+    sendMacro(keyboard, itemMacro, IN=INvalue)
     printLog('Entered ' + str(INvalue) + ' into \'Item, Rev\' field')
     
-# Switch windows, enter &Qvalue into Quantity Oracle Field and check checkbox
-def quantity(keyboard, Qvalue):
-
-    # Change to Receipts block with Shift + Page Down
-    shiftPgDn(keyboard)
-
-    # Check checkbox with space
-    keyboard.press(Key.space)
-    keyboard.release(Key.space)
+# Enter subinventory &data or bypass, then save and return to receipts
+@traced('subinventory')
+def enterSubinventory(keyboard, data):
+
+    # Check for bypass or subinventory
+    if data == 'bypassSub': 
+        sendMacro(keyboard, saveReceiptMacro)
+        printLog('Bypassing subinventory...')
+    else:
+        sendMacro(keyboard, compileMacro(('{SUB}',) + saveReceiptMacroSteps), SUB=data)
+        printLog('Entered ' + str(data) + ' into \'subinventory\' field')
 
-    # Tab over and enter Quantity
-    pressTab(keyboard, 1)
-    keyboard.type(Qvalue)
+# Close the finished receipt and open Receipts again
+@traced('setupNext')
+def reopenReceipts(keyboard):
+    sendMacro(keyboard, reopenReceiptsMacro)
     
-    printLog('Entered ' + str(Qvalue) + ' into \'Quantity\' field')
+# Enter correction &Qvalue unless &data bypasses it, then save and reopen
+@traced('correction')
+def enterCorrection(keyboard, Qvalue, data):
 
-# Enter subinventory or bypass if not needed
-def subinventory(keyboard, ser):
-    
-    # Adjust user view to see subinventory textbox
-    pressTab(keyboard, 10)
-    pressTab(keyboard, -2)
-    
-    # Wait for scan to see what to do
-    data = nextScan('Waiting for subinventory or bypass...', ser)
-
-    # Check for mode change
-    if not checkModeChange(data):
-        # Check for bypass or subinventory
-        if data == 'bypassSub': 
-            printLog('Bypassing subinventory...')
-        else:
-            keyboard.type(data) 
-            printLog('Entered ' + str(data) + ' into \'subinventory\' field')
-        keyboard.press(Key.enter)
-        keyboard.release(Key.enter)
-        
-        # Save changes
-        with keyboard.pressed(Key.ctrl): 
-            keyboard.press('s')
-            keyboard.release('s')
-            
-        # Switch to Receipt Window
-        changeWindows(keyboard, 4)
-    
-    # Return data in case of Mode Change
-    return data
-    
-# Set up next receipt
-def setupNext(keyboard, ser):
+    if data == 'bypassSub':
+        sendMacro(keyboard, saveCorrectionMacro)
+        printLog('Bypassed \'Quantity\' field')
+    else:
+        sendMacro(keyboard, compileMacro(('-', '{Q}') + saveCorrectionMacroSteps), Q=str(Qvalue))
+        printLog('Entered -' + str(Qvalue) + ' into \'Correction\' field')
 
-    data = nextScan('Waiting for \'Find Receipt Mode\' scan to continue...', ser)
-    if checkModeChange(data) and changeMode(data) == 'findReceipt':
-        
-        # Switch windows to be able to close
-        changeWindows(keyboard, 2)
+# Keystrokes for each Oracle form step, compiled once at startup
+itemMacro = compileMacro((
+    '{IN}', 'enter',                    # Type Item Number and hit enter
+    ))
+receiptMacro = compileMacro((
+    '{PO}', 'tab*7', '@purchaseOrder',  # Purchase Order Field
+    '{IN}', 'enter', '@itemNumber',     # Item Number Field
+    'shift+shift_r+page_down', 'space', # Quantity Field
+    'tab', '{Q}', '@quantity',
+    'tab*10', 'shift+tab*2',            # Adjust view to see subinventory
+    ))
+saveReceiptMacroSteps = (
+    'enter', 'ctrl+s',                  # Save changes
+    '>4',                               # Switch to Receipt Window
+    )
+saveReceiptMacro = compileMacro(saveReceiptMacroSteps)
+reopenReceiptsMacro = compileMacro((
+    '>2',                               # Switch windows to be able to close
+    'f4', '~window',                    # Close window
+    'r', 'enter', '~window',            # Open Receipts
+    ))
+saveCorrectionMacroSteps = (
+    'ctrl+s',                           # Save changes
+    'f4', '~window',                    # Close window
+    'c', 'enter', '~window', 'tab*3',   # Open Corrections
+    )
+saveCorrectionMacro = compileMacro(saveCorrectionMacroSteps)
 
-        # Close window with F4
-        keyboard.press(Key.f4)
-        keyboard.release(Key.f4) 
-    
-        # Open Receipts with Enter
-        keyboard.type('r')
-        keyboard.press(Key.enter)
-        keyboard.release(Key.enter)
+####################
+#    WORKFLOWS     #
+####################
 
-    return data
-    
-# Correct Quantity
-def correctQuantity(keyboard, Qvalue, ser):
+# Progress through one run of a workflow
+class WorkflowContext(object):
+    def __init__(self, workflow, state):
+        self.workflow = workflow
+        self.state = state
+        self.QR = None
+        self.result = None
+        self.outcome = 'completed'
+        self.override = False
+        self.key = None
+
+# Classify a scan as 'mode', 'bypass', 'qr' or 'text'
+def classifyScan(data):
+    if checkModeChange(data):
+        return 'mode'
+    if data == 'bypassSub':
+        return 'bypass'
+    if isPayload(data):
+        return 'qr'
+    return 'text'
+
+# Declarative workflow. &prompts maps each state to the text shown while
+# waiting for its scan and &table lists (state, scan, action, next) rows.
+# A row's scan is an exact scan, a scan class from classifyScan, or 'any'
+# for everything but mode scans. Its action(keyboard, context, data) sends
+# the keystrokes, and a next state of None completes the workflow.
+# Rows are indexed up front so each scan costs at most three dict lookups.
+class Workflow(object):
+    def __init__(self, name, start, prompts, table):
+        self.name = name
+        self.start = start
+        self.prompts = prompts
+        self.transitions = {}
+        for state, scan, action, nextState in table:
+            self.transitions[(state, scan)] = (action, nextState)
+        self.suspended = {}
+
+    # Start a new run, or resume one that a different mode or a timeout
+    # interrupted. Scanning the same mode again, or one with no handler,
+    # backs out of it
+    def begin(self):
+        suspended = self.suspended.pop(getattr(sessionInfo, 'port', None), None)
+        if suspended is None:
+            return WorkflowContext(self.name, self.start)
+        context, interrupter = suspended
+        if interrupter is not None and (interrupter == getattr(sessionInfo, 'mode', None)
+                                        or interrupter not in modeRegistry):
+            printLog('Dropped unfinished ' + self.name + ' at \'' + context.state + '\'')
+            return WorkflowContext(self.name, self.start)
+        printLog('Resuming ' + self.name + ' at \'' + context.state + '\'...')
+        return context
+
+    # Journal &context as interrupted by &mode, None for a timeout, and keep
+    # it for begin if it was part way through
+    def interrupt(self, context, mode):
+        journalScan(context.QR, self.name, 'interrupted')
+        if resumeWorkflows and context.state != self.start:
+            self.suspended[getattr(sessionInfo, 'port', None)] = (context, mode)
+
+    # Handle &data in the current state. Returns (True, next mode) once the
+    # workflow completes or is interrupted, otherwise (False, None)
+    def advance(self, keyboard, context, data):
+
+        kind = classifyScan(data)
+        transition = self.transitions.get((context.state, data))
+        if transition is None:
+            transition = self.transitions.get((context.state, kind))
+
+        # Mode scans with no row of their own interrupt the workflow
+        if transition is None and kind == 'mode':
+            mode = changeMode(data)
+            self.interrupt(context, mode)
+            return True, mode
+
+        if transition is None:
+            transition = self.transitions.get((context.state, 'any'))
+        if transition is None:
+            printLog('UNEXPECTED SCAN: ' + data)
+            return False, None
+
+        action, nextState = transition
+        if action is not None:
+            try:
+                action(keyboard, context, data)
+            except ScanFormatError as e:
+                printLog('INVALID QR CODE: ' + str(e))
+                return False, None
+            except ScanRejected as e:
+                printLog('SCAN REJECTED: ' + str(e))
+                return False, None
+        if nextState is not None:
+            context.state = nextState
+            return False, None
+        journalScan(context.QR, self.name, context.outcome)
+
+        if context.result is not None:
+            return True, context.result
+        if kind == 'mode':
+            return True, changeMode(data)
+        return True, data
+
+# Run &workflow on scans from &ser and return the next mode
+def runWorkflow(workflow, keyboard, ser):
+
+    context = workflow.begin()
+    while True:
+        data = nextScan(workflow.prompts[context.state], ser)
+        done, mode = workflow.advance(keyboard, context, data)
+        if done:
+            return mode
+
+# Parse &data and check it may be entered, journaling it as 'rejected'
+# if not. Returns the QR and its duplicate cache key for rememberScan
+def checkScan(context, data, openLine=True, duplicates=True):
+    QR = parseScan(data)
+    try:
+        key = checkDuplicate(context, data) if duplicates else None
+        if openLine:
+            checkOpenLine(QR)
+    except ScanRejected:
+        journalScan(QR, context.workflow, 'rejected')
+        raise
+    return QR, key
+
+# Receipt: enter PO, item and quantity, then subinventory, then reopen
+@traced('receipt')
+def enterReceipt(keyboard, context, data):
 
-    # Select which field to correct 
-    data = nextScan('Waiting for confirmation...', ser)
+    # Separate string into class QR
+    QR, context.key = checkScan(context, data)
+    context.QR = QR
+    typeReceipt(keyboard, QR)
+
+# Type the PO, item and quantity of a checked &QR into the Receipts form
+def typeReceipt(keyboard, QR):
+    sendMacro(keyboard, receiptMacro, PO=QR.PurchaseOrder, IN=QR.ItemNumber, Q=str(QR.Quantity))
+    printLog('Entered ' + str(QR.PurchaseOrder) + ' into \'Purchase Order\' field')
+    printLog('Entered ' + str(QR.ItemNumber) + ' into \'Item, Rev\' field')
+    printLog('Entered ' + str(QR.Quantity) + ' into \'Quantity\' field')
+
+# Enter the subinventory and save, only then is the receipt a duplicate
+def saveReceipt(keyboard, context, data):
+    enterSubinventory(keyboard, data)
+    rememberScan(context.key)
+
+receiptWorkflow = Workflow('receipt', 'qr', {
+        'qr':'Waiting for Receipt QR scan...',
+        'sub':'Waiting for subinventory or bypass...',
+        'next':'Waiting for \'Find Receipt Mode\' scan to continue...',
+    }, [
+        ('qr', 'qr', enterReceipt, 'sub'),
+        ('qr', overrideScan, armOverride, 'qr'),
+        ('sub', 'any', saveReceipt, 'next'),
+        ('next', 'setMode:findReceipt', lambda keyboard, context, data: reopenReceipts(keyboard), None),
+        # Go straight to a correction, leaving the receipt open
+        ('next', 'setMode:aaa', None, None),
+    ])
+
+# Correction: enter PO and item, then the corrected quantity, twice
+def startCorrection(keyboard, context, data):
+    QR, context.key = checkScan(context, data, openLine=False)
+    context.QR = QR
+    typeCorrection(keyboard, QR)
+
+# Type the PO and item of &QR into the Corrections form
+def typeCorrection(keyboard, QR):
+    purchaseOrder(keyboard, QR.PurchaseOrder, 6)
+    itemNumber(keyboard, QR.ItemNumber)
 
-    # Check for a mode change
-    if checkModeChange(data):
-        return data
-    elif data == 'bypassSub':
-        printLog('Bypassed \'Quantity\' field')
+def repeatCorrection(keyboard, context, data):
+    enterCorrection(keyboard, context.QR.Quantity, data)
+    purchaseOrder(keyboard, context.QR.PurchaseOrder, 6)
+    itemNumber(keyboard, context.QR.ItemNumber)
+
+def finishCorrection(keyboard, context, data):
+    enterCorrection(keyboard, context.QR.Quantity, data)
+    rememberScan(context.key)
+
+correctionWorkflow = Workflow('correction', 'qr', {
+        'qr':'Waiting for Correction QR scan...',
+        'first':'Waiting for confirmation...',
+        'second':'Waiting for confirmation...',
+    }, [
+        ('qr', 'qr', startCorrection, 'first'),
+        ('qr', overrideScan, armOverride, 'qr'),
+        ('first', 'any', repeatCorrection, 'second'),
+        ('second', 'any', finishCorrection, None),
+    ])
+
+# Print: type and log whatever is scanned, then stay in Print Data
+def printData(keyboard, context, data):
+    keyboard.type(data)
+    printLog(data)
+    context.result = 'printData'
+
+printWorkflow = Workflow('print', 'scan', {
+        'scan':'Waiting for scan...',
+    }, [
+        ('scan', 'any', printData, None),
+    ])
+
+# Offline: check receipt scans and queue them with their subinventory
+def queueReceipt(keyboard, context, data):
+    QR, _ = checkScan(context, data, duplicates=False)
+    context.QR = QR
+    context.scan = data
+
+def queueSubinventory(keyboard, context, data):
+    id = scanQueue.add(context.scan, data)
+    printLog('Queued receipt ' + str(id) + ': ' + context.scan + ' with ' + data)
+    context.result = 'offline'
+    context.outcome = 'queued'
+
+offlineWorkflow = Workflow('offline', 'qr', {
+        'qr':'OFFLINE - Waiting for Receipt QR scan to queue...',
+        'sub':'OFFLINE - Waiting for subinventory or bypass...',
+    }, [
+        ('qr', 'qr', queueReceipt, 'sub'),
+        ('sub', 'any', queueSubinventory, None),
+    ])
+
+# One whole receipt or correction from &scan, already parsed and checked
+# into &QR, and its &answer, with the same keystrokes the workflows send
+# for the scans they would wait for. Only the duplicate check is left, it
+# depends on the scans entered before. A correction without an answer is
+# entered, 'bypassSub' skips it
+def batchReceipt(keyboard, context, scan, QR, answer):
+    context.key = checkDuplicate(context, scan)
+    context.QR = QR
+    typeReceipt(keyboard, QR)
+    saveReceipt(keyboard, context, answer or batchAnswer)
+    reopenReceipts(keyboard)
+
+def batchCorrection(keyboard, context, scan, QR, answer):
+    context.key = checkDuplicate(context, scan)
+    context.QR = QR
+    typeCorrection(keyboard, QR)
+    repeatCorrection(keyboard, context, answer)
+    finishCorrection(keyboard, context, answer)
+
+# Read and check the lines of batch file &fname from line &first on, on a
+# thread of its own, queueing (line number, payload, QR, answer, error)
+# ahead of the keystrokes
+class BatchReader(object):
+    def __init__(self, fname, checkOpen, first=1, maxLines=batchQueueSize):
+        self.fname = fname
+        self.checkOpen = checkOpen
+        self.first = first
+        self.lines = queue.Queue(maxLines)
+        self.stopped = threading.Event()
+        self.parseTime = 0.0
+        self.thread = threading.Thread(target=self.run, name='BatchReader', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            with open(self.fname, encoding=scanEncoding, errors='replace') as batch:
+                for number, line in enumerate(batch, 1):
+                    scan, _, answer = line.rstrip('\r\n').partition('\t')
+                    if number < self.first or len(scan.strip()) == 0:
+                        continue
+                    started = time.perf_counter()
+                    QR = error = None
+                    try:
+                        QR = parseScan(scan)
+                        if self.checkOpen:
+                            checkOpenLine(QR)
+                    except (ScanFormatError, ScanRejected) as e:
+                        error = e
+                    self.parseTime += time.perf_counter() - started
+                    if not self.put((number, scan, QR, answer, error)):
+                        return
+        except OSError as e:
+            self.put((0, '', None, '', e))
+        self.put(None)
+
+    # Queue &item, giving up if the import is stopped meanwhile
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.lines.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+# Line number and state, 'started' or 'done', of the last line of a batch
+# file handled, kept in &fname beside it. (0, 'done') if there is none
+def loadBatchProgress(fname):
+    try:
+        with open(fname) as progress:
+            number, _, state = progress.read().strip().partition('\t')
+            return int(number), state
+    except (OSError, ValueError):
+        return 0, 'done'
+
+def saveBatchProgress(fname, number, state):
+    with open(fname, 'w') as progress:
+        progress.write(str(number) + '\t' + state + '\n')
+
+# Enter every line of the batch file through &steps without waiting for
+# scans, then rename the file so it isn't imported twice. Each line is
+# recorded in a progress file as it is started and done, so an import that
+# is stopped by a scan, or crashes, carries on after the last line handled.
+# A line that was started but never finished may already be in Oracle, so
+# it is reported for the operator to check, not entered again. Returns the
+# mode to change to
+def batchImport(keyboard, pump, workflow, steps, mode, fname=None):
+
+    if fname is None:
+        fname = scannerFolder(getpass.getuser()) + batchFile
+    if not os.path.exists(fname):
+        printLog('BATCH FILE NOT FOUND: ' + fname)
+        return mode
+
+    progressName = fname + '.progress'
+    last, state = loadBatchProgress(progressName)
+    if state == 'started':
+        printLog('BATCH LINE HELD: line ' + str(last) + ' was interrupted, '
+                 + 'check it in Oracle and enter it by hand if missing')
+        saveBatchProgress(progressName, last, 'done')
+    if last > 0:
+        printLog('Importing ' + fname + ' from line ' + str(last + 1) + '...')
     else:
-        keyboard.press('-')
-        keyboard.release('-')
-        keyboard.type(Qvalue)
-        printLog('Entered -' + str(Qvalue) + ' into \'Correction\' field')
-    
+        printLog('Importing ' + fname + '...')
+    reader = BatchReader(fname, workflow is receiptWorkflow, last + 1).start()
+    started = time.perf_counter()
+    waited = 0.0
+    entered = rejected = 0
+    try:
+        while True:
+            waiting = time.perf_counter()
+            line = reader.lines.get()
+            waited += time.perf_counter() - waiting
+            if line is None:
+                break
+
+            number, scan, QR, answer, error = line
+            context = WorkflowContext(workflow.name, 'qr')
+            try:
+                if error is not None:
+                    raise error
+                saveBatchProgress(progressName, number, 'started')
+                steps(keyboard, context, scan, QR, answer)
+            except (ScanFormatError, ScanRejected) as e:
+                printLog('SCAN REJECTED: line ' + str(number) + ': ' + str(e))
+                journalScan(QR, workflow.name, 'rejected')
+                rejected += 1
+            except OSError as e:
+                printLog('UNABLE TO READ BATCH FILE: ' + repr(e))
+                return mode
+            else:
+                journalScan(context.QR, workflow.name, 'imported')
+                entered += 1
+                printLog('Imported line ' + str(number))
+            saveBatchProgress(progressName, number, 'done')
+
+            data = decodeScan(pump.readScan(0))
+            if len(data) > 0:
+                printLog('BATCH IMPORT STOPPED at line ' + str(number))
+                if checkModeChange(data):
+                    mode = changeMode(data)
+                return mode
+        os.replace(fname, os.path.splitext(fname)[0] + time.strftime('.%Y%m%d-%H%M%S.done'))
+        if os.path.exists(progressName):
+            os.remove(progressName)
+    finally:
+        reader.stop()
+        elapsed = time.perf_counter() - started
+        printLog('Batch import: ' + str(entered) + ' entered, ' + str(rejected) + ' rejected in '
+                 + '%.1fs (%.1f per minute), parsing %.1fms, waiting on the file %.1fs'
+                 % (elapsed, 60 * entered / elapsed if elapsed > 0 else 0.0,
+                    1000 * reader.parseTime, waited))
+    return mode
+
+# Enter every queued receipt into Oracle as the receipt workflow would,
+# starting from an open Receipts form. Receipts an earlier replay stopped
+# in the middle of are held and reported, not sent again. Any scan stops
+# the replay after the current receipt. Returns the mode to change to
+def replayQueue(keyboard, pump):
+
+    receipts = scanQueue.pending()
+    printLog('Replaying ' + str(len(receipts)) + ' queued receipts...')
+    for count, (id, scan, subinventory, status) in enumerate(receipts, 1):
+        if status == 'started':
+            scanQueue.mark(id, 'held')
+            printLog('REPLAY HELD: receipt ' + str(id) + ': ' + scan + ' with ' + subinventory
+                     + ' was interrupted, check it in Oracle and enter it by hand if missing')
+            continue
+
+        context = WorkflowContext(receiptWorkflow.name, 'qr')
+        scanQueue.mark(id, 'started')
+        QR = None
+        try:
+            QR = parseScan(scan)
+            checkOpenLine(QR)
+            batchReceipt(keyboard, context, scan, QR, subinventory)
+        except (ScanFormatError, ScanRejected) as e:
+            printLog('SCAN REJECTED: receipt ' + str(id) + ': ' + str(e))
+            journalScan(QR, receiptWorkflow.name, 'rejected')
+            scanQueue.mark(id, 'rejected')
+            continue
+        scanQueue.mark(id, 'done')
+        journalScan(context.QR, receiptWorkflow.name, 'replayed')
+        printLog('Replayed ' + str(count) + ' of ' + str(len(receipts)))
+
+        data = decodeScan(pump.readScan(0))
+        if len(data) > 0:
+            printLog('REPLAY STOPPED: ' + str(len(receipts) - count) + ' receipts still queued')
+            if checkModeChange(data):
+                return changeMode(data)
+            break
+    return defaultMode()
+
+# Offline
+@registerMode('offline', '\'Offline Queue\'')
+def offlineProcedure(keyboard, ser):
+    if scanQueue is None:
+        printLog('OFFLINE QUEUE NOT AVAILABLE')
+        return defaultMode()
+    return runWorkflow(offlineWorkflow, keyboard, ser)
+
+# Replay Offline Queue
+@registerMode('replay', '\'Replay Offline Queue\'', waitsForScan=False)
+def replayProcedure(keyboard, ser):
+    if scanQueue is None:
+        printLog('OFFLINE QUEUE NOT AVAILABLE')
+        return defaultMode()
+    return replayQueue(keyboard, ser)
+
+# Dump Timings: write the latency trace beside the log and summarize it
+@registerMode('timings', '\'Dump Timings\'')
+def timingsProcedure(keyboard, ser):
+    if scanTrace is None:
+        printLog('LATENCY TRACING IS OFF, set latencyTracing to True')
+    else:
+        fname = scannerFolder(getpass.getuser()) + traceFile
+        try:
+            printLog('Wrote ' + str(scanTrace.dump(fname)) + ' timing spans to ' + fname)
+        except OSError as e:
+            printLog('UNABLE TO WRITE TIMINGS: ' + repr(e))
+    return defaultMode()
+
+# Batch Receipts
+@registerMode('batchReceipt', '\'Batch Receipts\'', waitsForScan=False)
+def batchReceiptProcedure(keyboard, ser):
+    return batchImport(keyboard, ser, receiptWorkflow, batchReceipt, 'bbb')
+
+# Batch Corrections
+@registerMode('batchCorrection', '\'Batch Corrections\'', waitsForScan=False)
+def batchCorrectionProcedure(keyboard, ser):
+    return batchImport(keyboard, ser, correctionWorkflow, batchCorrection, 'aaa')
 
-    
-    with keyboard.pressed(Key.ctrl): 
-        keyboard.press('s')
-        keyboard.release('s')
-    
-    # Close window with F4
-    keyboard.press(Key.f4)
-    keyboard.release(Key.f4) 
-    
-    # Open Corrections with Enter
-    keyboard.type('c')
-    keyboard.press(Key.enter)
-    keyboard.release(Key.enter)
-    pressTab(keyboard, 3)
-    return data
-    
 # BBB
+@registerMode('bbb', '\'### BBB ###\'')
 def bbbProcedure(keyboard, ser):
+    return runWorkflow(receiptWorkflow, keyboard, ser)
 
-    # Scan QR Code
-    data = nextScan('Waiting for Receipt QR scan...', ser)
-    
-    # Check for a mode change
-    if checkModeChange(data):
-        return changeMode(data)
-    
-    # Separate string into class QR
-    QR = separateQR(data)
-    
-    # Purchase Order Field
-    purchaseOrder(keyboard, QR.PurchaseOrder, 7)
+# AAA Procedure
+@registerMode('aaa', '\'### AAA ###\'')
+def aaaProcedure(keyboard, ser):
+    return runWorkflow(correctionWorkflow, keyboard, ser)
+
+# Print Data Procedure
+@registerMode('printData', '\'Print Data\'')
+def printDataProcedure(keyboard, ser):
+    return runWorkflow(printWorkflow, keyboard, ser)
+
+# Exit Procedure - Returns True if Exit Mode is scanned again
+def exitProcedure(ser):
     
-    # Item Number Field
-    itemNumber(keyboard, QR.ItemNumber)
+    # Double check that they want to exit
+    data = nextScan('Scan Exit again to terminate script', ser)
+    return data, not changeMode(data) == 'exit'
 
-    # Quantity Field
-    quantity(keyboard, QR.Quantity)
+# Exit - Exit Script Procedure, stops the mode loop if confirmed
+@registerMode('exit', '\'Exit Script\'')
+def exitMode(keyboard, ser):
+    data, loop = exitProcedure(ser)
+    return data if loop else None
+
+# The mode this scanner session returns to, set by the mode loop
+def defaultMode():
+    return sessionInfo.default
+
+# Run the mode state machine for one scanner until exit is scanned twice.
+# With &lock, the keyboard is only held while this scanner has a scan to act
+# on, or while a mode that doesn't wait for one runs
+def runModeLoop(keyboard, ser, default, lock=None):
+
+    mode = sessionInfo.default = default
+    while mode is not None:
+
+        handler = modeRegistry.get(mode)
+        if handler is None:
+            printLog('Returning to default mode...')
+            if mode == default:
+                default = sessionInfo.default = setDefaultMode(ser)
+            mode = default
+            continue
+        printLog('MODE: ' + handler.label)
+        sessionInfo.mode = handler.name
+
+        if lock is not None and handler.waitsForScan:
+            ser.waitScan()
+
+        start = time.perf_counter_ns()
+        with lock or contextlib.nullcontext():
+            result = handler.procedure(keyboard, ser)
+        if scanTrace is not None:
+            scanTrace.span('mode:' + handler.name, start, time.perf_counter_ns())
+        mode = None if result is None else handler.nextMode(result)
+
+# Scanner session thread for &port, sets &finished when it stops
+def runScanner(keyboard, ser, port, lock, finished):
+
+    sessionInfo.port = port
+    try:
+        default = setDefaultMode(ser)
+        runModeLoop(keyboard, ser, default, lock)
+    except Exception as e:
+        printLog('SCANNER SESSION FAILED: ' + repr(e))
+    finally:
+        finished.set()
+
+# Serve every matching scanner concurrently, one session thread per port.
+# Sessions share one keyboard, so a workflow holds it until it returns.
+# Exiting from any scanner stops them all.
+def runAllScanners(keyboard):
+
+    lock = threading.Lock()
+    finished = threading.Event()
+    pumps = []
+    for port in checkAllPorts():
+        reader = ScanReader(setupCOMPort(port))
+        if len(pumps) == 0:
+            # Housekeeping runs once, on the first scanner's reader
+            runHousekeepingIdle(reader)
+        ser = ScanPump(reader).start()
+        pumps.append(ser)
+        printLog('SCANNER READY ON PORT: ' + str(port))
+        threading.Thread(target=runScanner, name=str(port), daemon=True,
+                         args=(keyboard, ser, str(port), lock, finished)).start()
+
+    # Wait in short steps so Ctrl^C still reaches the main thread
+    while not finished.wait(readTimeout):
+        pass
+    for ser in pumps:
+        ser.close()
 
-    # Subinventory Field
-    data = subinventory(keyboard, ser)
+####################
+#  ASYNC ENGINE    #
+####################
 
-    # Check for a mode change
-    if checkModeChange(data):
-        return changeMode(data)
+# Awaitable view of a ScanPump's queue. The pump's reader thread only wakes
+# the event loop, scans stay in the pump's queue until a coroutine takes
+# one, so cancelling a wait never loses a scan.
+class AsyncScanStream(object):
+    def __init__(self, pump):
+        self.pump = pump
+        self.ready = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        pump.notify = lambda: loop.call_soon_threadsafe(self.ready.set)
+
+    # Return the next scan, or b'' after &timeout seconds
+    async def readScan(self, timeout=None):
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            self.ready.clear()
+            frame = self.pump.readScan(0)
+            if len(frame) > 0:
+                return frame
+            wait = self.pump.reader.idleTimeout
+            if timeout is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return b''
+            try:
+                await asyncio.wait_for(self.ready.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
 
-    # Close and reopen Receipts Tool
-    data = setupNext(keyboard, ser)
+# Returns the next scanned data, or an empty string if &timeout seconds pass
+async def nextScanAsync(text, stream, timeout=None):
 
-    # Check for a mode change
-    if not data == 'setMode:aaa' and checkModeChange(data):
-        return changeMode(data)
-    
+    start = time.perf_counter_ns()
+    printLog(text)
+    data = decodeScan(await stream.readScan(timeout))
+    if scanTrace is not None:
+        scanTrace.span('nextScan', start, time.perf_counter_ns())
     return data
 
-# AAA Procedure
-def aaaProcedure(keyboard, ser):
-
-    # Scan QR Code
-    data = nextScan('Waiting for Correction QR scan...', ser)
-    
-    # Check for a mode change
-    if checkModeChange(data):
-        return changeMode(data)
-    
-    # Separate string into class QR
-    QR = separateQR(data)
+# Set default mode and return it
+async def setDefaultModeAsync(stream):
 
-    # Enter Purchase Order, Item Number and Corrected Quantity
-    for _ in range(2): 
-        purchaseOrder(keyboard, QR.PurchaseOrder, 6)
-        itemNumber(keyboard, QR.ItemNumber)
-        data = correctQuantity(keyboard, QR.Quantity, ser)
-        # Check for a mode change
+    while True:
+        data = await nextScanAsync('Scan a mode to begin...', stream)
         if checkModeChange(data):
-            return changeMode(data)
+            default = changeMode(data)
+            # Avoid exit as default mode
+            if default == 'exit':
+                default = 'findReceipt'
+            return default
+
+# Run &workflow on scans from &stream and return the next mode. If the mode
+# times out part way through, the run is journaled and kept like one a mode
+# scan interrupted, so the next scan for it isn't unexpected
+async def runWorkflowAsync(workflow, keyboard, stream):
+
+    context = workflow.begin()
+    while True:
+        try:
+            data = await nextScanAsync(workflow.prompts[context.state], stream)
+        except asyncio.CancelledError:
+            workflow.interrupt(context, None)
+            raise
+        done, mode = workflow.advance(keyboard, context, data)
+        if done:
+            return mode
 
-    return data
+# BBB
+@registerAsyncMode('bbb')
+async def bbbProcedureAsync(keyboard, stream):
+    return await runWorkflowAsync(receiptWorkflow, keyboard, stream)
+
+# AAA Procedure
+@registerAsyncMode('aaa')
+async def aaaProcedureAsync(keyboard, stream):
+    return await runWorkflowAsync(correctionWorkflow, keyboard, stream)
 
 # Print Data Procedure
-def printDataProcedure(keyboard, ser):
-    
-    data = nextScan('Waiting for scan...', ser)
-    
-    # Check for a mode change
-    if checkModeChange(data):
-        return changeMode(data)
-    else:
-        keyboard.type(data)
-        printLog(data)
-        return 'printData'
+@registerAsyncMode('printData')
+async def printDataProcedureAsync(keyboard, stream):
+    return await runWorkflowAsync(printWorkflow, keyboard, stream)
+
+# Offline
+@registerAsyncMode('offline')
+async def offlineProcedureAsync(keyboard, stream):
+    if scanQueue is None:
+        printLog('OFFLINE QUEUE NOT AVAILABLE')
+        return defaultMode()
+    return await runWorkflowAsync(offlineWorkflow, keyboard, stream)
+
+# Replay Offline Queue, keystrokes are never awaited so it runs straight through
+@registerAsyncMode('replay')
+async def replayProcedureAsync(keyboard, stream):
+    if scanQueue is None:
+        printLog('OFFLINE QUEUE NOT AVAILABLE')
+        return defaultMode()
+    return replayQueue(keyboard, stream.pump)
+
+# Batch Receipts and Corrections, run straight through like the replay
+@registerAsyncMode('batchReceipt')
+async def batchReceiptProcedureAsync(keyboard, stream):
+    return batchImport(keyboard, stream.pump, receiptWorkflow, batchReceipt, 'bbb')
+
+@registerAsyncMode('batchCorrection')
+async def batchCorrectionProcedureAsync(keyboard, stream):
+    return batchImport(keyboard, stream.pump, correctionWorkflow, batchCorrection, 'aaa')
+
+# Dump Timings
+@registerAsyncMode('timings')
+async def timingsProcedureAsync(keyboard, stream):
+    return timingsProcedure(keyboard, stream)
 
 # Exit Procedure - Returns True if Exit Mode is scanned again
-def exitProcedure(ser):
-    
-    # Double check that they want to exit
-    data = nextScan('Scan Exit again to terminate script', ser)
+async def exitProcedureAsync(stream):
+
+    data = await nextScanAsync('Scan Exit again to terminate script', stream)
     return data, not changeMode(data) == 'exit'
+
+# Exit - Exit Script Procedure, stops the mode loop if confirmed
+@registerAsyncMode('exit')
+async def exitModeAsync(keyboard, stream):
+    data, loop = await exitProcedureAsync(stream)
+    return data if loop else None
+
+# Run the mode state machine as a coroutine until exit is scanned twice.
+# A procedure waiting longer than &timeout for a scan is cancelled and the
+# mode returns to default. Keystrokes are never awaited, so cancellation
+# only ever lands between scans.
+async def runModeLoopAsync(keyboard, stream, default, timeout=modeTimeout):
+
+    mode = sessionInfo.default = default
+    while mode is not None:
+
+        handler = modeRegistry.get(mode)
+        if handler is None or handler.asyncProcedure is None:
+            printLog('Returning to default mode...')
+            if mode == default:
+                default = sessionInfo.default = await setDefaultModeAsync(stream)
+            mode = default
+            continue
+        printLog('MODE: ' + handler.label)
+        sessionInfo.mode = handler.name
+
+        start = time.perf_counter_ns()
+        try:
+            result = await asyncio.wait_for(handler.asyncProcedure(keyboard, stream), timeout)
+            if scanTrace is not None:
+                scanTrace.span('mode:' + handler.name, start, time.perf_counter_ns())
+        except asyncio.TimeoutError:
+            printLog('MODE TIMED OUT. Returning to default mode...')
+            mode = default
+            continue
+        mode = None if result is None else handler.nextMode(result)
+
+# Call &task every &interval seconds until cancelled
+async def periodic(interval, task):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            task()
+        except Exception as e:
+            printLog('HOUSEKEEPING FAILED: ' + repr(e))
+
+# Report a scanner whose reader thread has died
+def checkPortHealth(pump):
+    if pump.error is not None or not pump.thread.is_alive():
+        printLog('SCANNER PORT NOT RESPONDING: ' + str(pump.error))
+
+# Write the latency trace beside the log while tracing is on, so it
+# survives a crash without anyone scanning setMode:timings
+def flushTimings():
+    if scanTrace is not None:
+        scanTrace.dump(scannerFolder(getpass.getuser()) + traceFile, summary=False)
+
+# Housekeeping run alongside the mode loop as (interval, task) pairs. The
+# port health check is added per pump by runEngine
+housekeeping = [
+    (logFlushInterval, maintainLog),
+    (traceFlushInterval, flushTimings),
+    ]
+
+# Runs &task from a reader's idle wake-ups at most every &interval
+# seconds, for the engines without an event loop. A task only runs while
+# no one is scanning, and every scan logs a line, which flushes the log
+class IdleTask(object):
+    def __init__(self, interval, task):
+        self.interval = interval
+        self.task = task
+        self.due = time.monotonic() + interval
+
+    def __call__(self):
+        now = time.monotonic()
+        if now < self.due:
+            return
+        self.due = now + self.interval
+        try:
+            self.task()
+        except Exception as e:
+            printLog('HOUSEKEEPING FAILED: ' + repr(e))
+
+# Run the housekeeping tasks on &reader's thread while it waits for scans
+def runHousekeepingIdle(reader):
+    for interval, task in housekeeping:
+        reader.onIdle(IdleTask(interval, task))
+
+# Serve &pump with the asyncio engine until exit is scanned twice.
+# Keystrokes are sent synchronously, so while a macro is paced, including
+# a window wait of up to windowTimeout, the event loop is blocked and the
+# housekeeping tasks run late
+async def runEngine(keyboard, pump):
+
+    stream = AsyncScanStream(pump)
+    tasks = [asyncio.create_task(periodic(interval, task)) for interval, task in housekeeping]
+    tasks.append(asyncio.create_task(periodic(30.0, lambda: checkPortHealth(pump))))
+    try:
+        default = await setDefaultModeAsync(stream)
+        await runModeLoopAsync(keyboard, stream, default)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
     
 
 
@@ -436,6 +2527,8 @@ def exitProcedure(ser):
 
 def main():
     
+    global logWriter, pacer, scanJournal, scanCache, masterData, scanQueue, scanTrace
+
     try:
         # Get Current User
         user = getpass.getuser()
@@ -445,64 +2538,71 @@ def main():
         sys.exit()
 
     try:    
-        # Open Log File
-        sys.stdout = openLogFile(user)
+        # Open Log File, anything printed goes through the log writer
+        logWriter = openLogFile(user)
+        sys.stdout = logWriter
         
     except IOError:
         printLog('IOError: Unable to open file')
         sys.exit()
-    
+
+    # Header, before anything the setup below logs
+    printHeader(user)
+
     try:
-        # Header
-        printHeader(user)
+        # Open Scan Journal
+        scanJournal = ScanJournal(scannerFolder(user) + 'ScanJournal.jsonl')
 
-        # Set up COM port and controller
-        ser = setupCOMPort()
-        keyboard = Controller()
+    except (IOError, ValueError) as e:
+        printLog('UNABLE TO OPEN SCAN JOURNAL: ' + repr(e))
 
-        # Set default mode
-        default = setDefaultMode(ser)
-        mode = default
+    if dedupeTTL > 0:
+        try:
+            # Load recently entered scans
+            scanCache = ScanCache(fname=scannerFolder(user) + 'ScanCache.txt' if dedupePersist else None)
 
-        # Initialize data to empty
-        data = ''
-        
-        # Loop until exit is scanned twice
-        loop = True
-        while loop:
-            
-            try:
-                printLog('MODE: ' + modes[mode])
-            except:
-                printLog('Returning to default mode...')
-                mode = default
-                continue
+        except IOError as e:
+            printLog('UNABLE TO OPEN SCAN CACHE: ' + repr(e))
+            scanCache = ScanCache()
 
-            # Exit - Exit Script Procedure 
-            if mode == 'exit':
-                mode, loop = exitProcedure(ser)
-                continue
-                    
-            # Print Data - Type and print data to screen
-            elif mode == 'printData': 
-                mode = printDataProcedure(keyboard, ser)
-                continue
+    if masterDataFile:
+        # Load open PO lines, a bare file name is looked for in the scanner folder
+        masterData = MasterData(os.path.join(scannerFolder(user), masterDataFile))
+        masterData.refresh()
+
+    try:
+        # Open receipts queued while offline
+        scanQueue = ScanQueue(scannerFolder(user) + queueFile)
+        queued = len(scanQueue.pending())
+        if queued > 0:
+            printLog(str(queued) + ' RECEIPTS QUEUED OFFLINE, scan \'Replay Offline Queue\' to enter them')
+
+    except sqlite3.Error as e:
+        printLog('UNABLE TO OPEN OFFLINE QUEUE: ' + repr(e))
+    
+    try:
+        # Set up modes, keystroke output and pacing
+        loadModePlugins()
+        keyboard = outputBackends[outputBackend]()
+        if latencyTracing:
+            scanTrace = ScanTrace()
+        if adaptivePacing:
+            pacer = Pacer()
+
+        if multiPort:
+            # Serve every matching scanner with its own mode state
+            runAllScanners(keyboard)
+        elif asyncEngine:
+            # Run the mode loop and housekeeping in one event loop
+            asyncio.run(runEngine(keyboard, ScanPump(ScanReader(setupCOMPort())).start()))
+        else:
+            # Set up COM port and default mode, housekeeping runs while idle
+            reader = ScanReader(setupCOMPort())
+            runHousekeepingIdle(reader)
+            ser = ScanPump(reader).start()
+            default = setDefaultMode(ser)
+            runModeLoop(keyboard, ser, default)
 
-            # BBB
-            elif mode == 'bbb': 
-                mode = bbbProcedure(keyboard, ser)
-                continue
-                
-            # AAA
-            elif mode == 'aaa':
-                mode = aaaProcedure(keyboard, ser)
-                continue
-            
-            # Check for a mode change
-            if checkModeChange(data):
-                mode = changeMode(data)
-                continue
-        
     # Remove traceback error on Ctrl^C
     except KeyboardInterrupt:
         printLog('KeyboardInterrupt')
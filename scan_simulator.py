@@ -0,0 +1,263 @@
+#!python3
+# -*- coding: UTF-8 -*-
+
+'''
+scan_simulator.py   Version 1.0
+    Plays a scan script into the receiving utility as if a barcode scanner
+    were attached. SimulatedSerial stands in for serial.Serial in-process,
+    and on Linux PtyScanner serves the same stream on a pseudo terminal
+    that setupCOMPort can open (set scannerPort in receiving_v4.py to the
+    path it prints). Scans are sent at a set rate, optionally in bursts,
+    with Poisson jitter, split into fragments or run together in one write.
+
+Script files hold one scan per line, e.g. setMode:bbb, 12345#ABC-1#1#5,
+bypassSub, setMode:findReceipt, setMode:exit. Blank lines are skipped.
+
+Usage:
+    python scan_simulator.py [SCRIPT] [--receipts 500] [--rate 5]
+                             [--burst 4] [--jitter] [--fragment 0.2]
+                             [--coalesce 0.2] [--repeat 10] [--seed 1]
+'''
+
+####################
+#     IMPORTS      #
+####################
+
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+terminator = b'\r\n'
+fragmentDelay = 0.005   # Seconds between the pieces of a fragmented scan, under scanGapTimeout
+burstDelay = 0.001      # Seconds between scans of a burst that aren't coalesced
+
+####################
+#     SCRIPTS      #
+####################
+
+# Read the scans of script file &path
+def loadScript(path):
+    with open(path, encoding='utf-8') as script:
+        return [line.rstrip('\r\n') for line in script if line.strip()]
+
+# A session entering &count receipts, alternating subinventory and bypass,
+# then exiting. Each receipt has its own PO so none is a duplicate
+def receiptScript(count, first=100000):
+
+    scans = ['setMode:bbb']
+    for number in range(first, first + count):
+        scans.append(str(number) + '#ITEM-' + str(number % 97) + '#1#' + str(number % 9 + 1))
+        scans.append('bypassSub' if number % 2 else 'SUB' + str(number % 5))
+        scans.append('setMode:findReceipt')
+    scans += ['setMode:exit', 'setMode:exit']
+    return scans
+
+####################
+#     FEEDER       #
+####################
+
+# Sends the scans of &script through &write on a thread of its own, &rate
+# scans a second on average in bursts of &burst. With &jitter the gaps
+# between bursts are drawn from an exponential distribution. A scan is
+# split into 2 to 4 writes with probability &fragment, or written together
+# with the next scan of its burst with probability &coalesce. Scans end in
+# &terminator, for a scanner that sends none each scan is one write. The
+# time the last byte of each scan was written is kept in &sent for latency checks.
+class ScanFeeder(object):
+    def __init__(self, write, script, rate=5.0, burst=1, jitter=False,
+                 fragment=0.0, coalesce=0.0, repeat=1, seed=None, terminator=terminator):
+        self.write = write
+        self.script = list(script)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.jitter = jitter
+        self.fragment = fragment
+        self.coalesce = coalesce
+        self.repeat = repeat
+        self.terminator = terminator
+        self.random = random.Random(seed)
+        self.sent = collections.deque()
+        self.frames = 0
+        self.writes = 0
+        self.stopped = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='ScanFeeder', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    # Seconds from one burst to the next
+    def gap(self):
+        if self.rate <= 0:
+            return 0.0
+        if self.jitter:
+            return self.random.expovariate(self.rate / self.burst)
+        return self.burst / self.rate
+
+    def run(self):
+        try:
+            scans = [scan.encode('utf-8') + self.terminator for scan in self.script]
+            for _ in range(self.repeat):
+                for start in range(0, len(scans), self.burst):
+                    due = time.monotonic() + self.gap()
+                    self.sendBurst(scans[start:start + self.burst])
+                    if self.stopped.wait(max(0.0, due - time.monotonic())):
+                        return
+        finally:
+            self.done.set()
+
+    # Write the scans of one burst, fragmenting or coalescing them
+    def sendBurst(self, frames):
+
+        pending = b''
+        for index, frame in enumerate(frames):
+            last = index == len(frames) - 1
+            if not last and self.random.random() < self.coalesce:
+                pending += frame
+                continue
+            frame, pending = pending + frame, b''
+            if self.random.random() < self.fragment and len(frame) > 2:
+                cuts = sorted(self.random.sample(range(1, len(frame) - 1), self.random.randint(1, 3)))
+                for piece in self.split(frame, cuts)[:-1]:
+                    self.send(piece)
+                    time.sleep(fragmentDelay)
+                frame = frame[cuts[-1]:]
+            self.send(frame)
+            if not last:
+                time.sleep(burstDelay)
+
+    @staticmethod
+    def split(frame, cuts):
+        return [frame[start:end] for start, end in zip([0] + cuts, cuts + [len(frame)])]
+
+    def send(self, data):
+        self.write(data)
+        self.writes += 1
+        now = time.monotonic()
+        for _ in range(data.count(self.terminator[-1:]) if self.terminator else 1):
+            self.sent.append(now)
+            self.frames += 1
+
+####################
+#     SERIAL       #
+####################
+
+# In-process stand-in for serial.Serial, with the read, in_waiting and
+# timeout behaviour ScanReader relies on. Start &feeder with feed as its write
+class SimulatedSerial(object):
+    def __init__(self, port='SIM', baudrate=115200, timeout=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.ready = threading.Condition()
+        self.is_open = True
+
+    # Add &data to what the utility will read
+    def feed(self, data):
+        with self.ready:
+            self.buffer += data
+            self.ready.notify_all()
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    # Return up to &size bytes, waiting up to timeout for the first of them.
+    # Like pyserial, reading a closed port raises an OSError
+    def read(self, size=1):
+        with self.ready:
+            if len(self.buffer) == 0 and self.timeout != 0:
+                self.ready.wait_for(lambda: len(self.buffer) > 0 or not self.is_open, self.timeout)
+            if not self.is_open:
+                raise OSError('Attempting to use a port that is not open')
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self.ready:
+            self.buffer.clear()
+
+    def close(self):
+        with self.ready:
+            self.is_open = False
+            self.ready.notify_all()
+
+# Run &script into a new SimulatedSerial, returns (serial, feeder)
+def simulate(script, **schedule):
+    ser = SimulatedSerial()
+    feeder = ScanFeeder(ser.feed, script, **schedule).start()
+    return ser, feeder
+
+# A pseudo terminal whose other end reads like a scanner's COM port. Linux only
+class PtyScanner(object):
+    def __init__(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self.master, view):]
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+####################
+#       MAIN       #
+####################
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Play scans into the receiving utility through a pseudo terminal.')
+    parser.add_argument('script', nargs='?', help='scan script, one scan per line (default: generated receipts)')
+    parser.add_argument('--receipts', type=int, default=100, help='receipts in the generated script')
+    parser.add_argument('--rate', type=float, default=5.0, help='average scans per second')
+    parser.add_argument('--burst', type=int, default=1, help='scans sent back to back')
+    parser.add_argument('--jitter', action='store_true', help='Poisson gaps between bursts')
+    parser.add_argument('--fragment', type=float, default=0.0, help='chance a scan is split into pieces')
+    parser.add_argument('--coalesce', type=float, default=0.0, help='chance a scan runs into the next')
+    parser.add_argument('--repeat', type=int, default=1, help='times to play the script')
+    parser.add_argument('--seed', type=int, help='random seed for repeatable runs')
+    args = parser.parse_args(argv)
+
+    if not hasattr(os, 'openpty') or sys.platform == 'win32':
+        parser.error('pseudo terminals need Linux, use SimulatedSerial in-process instead')
+    script = loadScript(args.script) if args.script else receiptScript(args.receipts)
+
+    scanner = PtyScanner()
+    print('Scanner simulator on ' + scanner.port + ', set scannerPort to it and start the utility')
+    input('Press Enter to start sending...')
+    feeder = ScanFeeder(scanner.write, script, rate=args.rate, burst=args.burst, jitter=args.jitter,
+                        fragment=args.fragment, coalesce=args.coalesce, repeat=args.repeat,
+                        seed=args.seed).start()
+    started = time.monotonic()
+    try:
+        while not feeder.done.wait(5.0):
+            print('Sent ' + str(feeder.frames) + ' scans in ' + str(feeder.writes) + ' writes')
+    except KeyboardInterrupt:
+        feeder.stop()
+        feeder.done.wait()
+    elapsed = time.monotonic() - started
+    print('Sent ' + str(feeder.frames) + ' scans in ' + str(feeder.writes) + ' writes, '
+          + '%.1fs, %.1f scans per second' % (elapsed, feeder.frames / elapsed if elapsed > 0 else 0.0))
+    input('Press Enter to close the port...')
+    scanner.close()
+
+if __name__ == "__main__":
+    main()
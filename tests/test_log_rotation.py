@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Tests for the log rotation of receiving_v4.py
+'''
+
+import gzip
+import os
+import time
+
+from receiving_v4 import LogRotator
+
+def write(path, text):
+    with open(path, 'w') as log:
+        log.write(text)
+
+def test_appends_to_current_log(tmp_path):
+    fname = str(tmp_path / 'ReceivingLog.txt')
+    write(fname, 'today\n')
+    rotator = LogRotator(fname, maxSize=1000, daily=True)
+    stream, size = rotator.open()
+    stream.close()
+    assert size == 6
+    assert os.listdir(str(tmp_path)) == ['ReceivingLog.txt']
+
+def test_rotates_on_size(tmp_path):
+    fname = str(tmp_path / 'ReceivingLog.txt')
+    rotator = LogRotator(fname, maxSize=10, daily=False)
+    stream, size = rotator.open()
+    stream.write('0123456789\n')
+    assert rotator.due(11)
+    stream, size = rotator.rotate(stream)
+    stream.close()
+    rotator.join()
+
+    archives = rotator.archives('.gz')
+    assert size == 0
+    assert len(archives) == 1
+    with gzip.open(archives[0], 'rt') as archive:
+        assert archive.read() == '0123456789\n'
+    assert rotator.archives() == []
+
+def test_rotates_yesterdays_log_on_open(tmp_path):
+    fname = str(tmp_path / 'ReceivingLog.txt')
+    write(fname, 'yesterday\n')
+    yesterday = time.time() - 86400
+    os.utime(fname, (yesterday, yesterday))
+
+    rotator = LogRotator(fname, maxSize=1000, daily=True)
+    stream, size = rotator.open()
+    stream.close()
+    rotator.join()
+    assert size == 0
+    assert len(rotator.archives('.gz')) == 1
+
+def test_rotates_when_the_day_changes(tmp_path):
+    rotator = LogRotator(str(tmp_path / 'ReceivingLog.txt'), maxSize=1000, daily=True)
+    stream, size = rotator.open()
+    stream.close()
+    assert not rotator.due(0)
+    rotator.day = '19990101'
+    assert rotator.due(0)
+    rotator.daily = False
+    assert not rotator.due(0)
+
+def test_keeps_newest_generations(tmp_path):
+    fname = str(tmp_path / 'ReceivingLog.txt')
+    rotator = LogRotator(fname, maxSize=1, daily=False, generations=2)
+    stream, size = rotator.open()
+    for count in range(4):
+        stream.write(str(count) + '\n')
+        stream, size = rotator.rotate(stream)
+        rotator.join()
+    stream.close()
+
+    assert len(rotator.archives('.gz')) == 2
+    assert rotator.archives() == []
+
+def test_compresses_leftover_archives(tmp_path):
+    fname = str(tmp_path / 'ReceivingLog.txt')
+    leftover = str(tmp_path / 'ReceivingLog.20240101-000000-000.txt')
+    write(leftover, 'left over\n')
+
+    rotator = LogRotator(fname, maxSize=1000, daily=False)
+    rotator.compressLeftovers()
+    rotator.join()
+    assert not os.path.exists(leftover)
+    with gzip.open(leftover + '.gz', 'rt') as archive:
+        assert archive.read() == 'left over\n'
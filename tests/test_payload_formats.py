@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Tests for the scan decoding and QR payload parsers of receiving_v4.py
+'''
+
+import pytest
+
+import receiving_v4 as receiving
+from receiving_v4 import QRCode, ScanFormatError
+
+expected = QRCode('40012345', 'ABC-1', 3, 12)
+
+####################
+#      DECODE      #
+####################
+
+def test_decodeScan_strips_terminator():
+    assert receiving.decodeScan(b'1234567#ABC-1#3#12\r\n') == '1234567#ABC-1#3#12'
+
+def test_decodeScan_drops_control_bytes():
+    assert receiving.decodeScan(b'\x021234567#AB\tC-1#3#12\x03\r\n') == '1234567#ABC-1#3#12'
+
+def test_decodeScan_keeps_fnc1():
+    assert receiving.decodeScan(b'\x1d40040012345\x1d241ABC-1\x1d913\x1d3012\r\n') \
+        == '\x1d40040012345\x1d241ABC-1\x1d913\x1d3012'
+
+def test_decodeScan_replaces_separators_only(monkeypatch):
+    monkeypatch.setattr(receiving, 'fnc1Separator', '|')
+    assert receiving.decodeScan(b'\x1d40040012345\x1d241ABC-1\r\n') == '\x1d40040012345|241ABC-1'
+
+####################
+#    DELIMITED     #
+####################
+
+def test_separateQR():
+    assert receiving.separateQR('40012345#ABC-1#3#12') == expected
+
+def test_separateQR_bytes():
+    assert receiving.separateQR(b'40012345#ABC-1#3#12') == expected
+
+@pytest.mark.parametrize('data', [
+    '40012345#ABC-1#3',
+    '40012345#ABC-1#3#12#1',
+    '#ABC-1#3#12',
+    '40012345##3#12',
+    '40012345#ABC-1#x#12',
+    '40012345#ABC-1#3#0',
+    '40012345#ABC-1#-1#12',
+    ])
+def test_separateQR_rejects(data):
+    with pytest.raises(ScanFormatError):
+        receiving.separateQR(data)
+
+@pytest.mark.parametrize('data', [
+    '40012345#ABC-1#3#12',
+    '40012345|ABC-1|3|12',
+    '40012345;ABC-1;3;12',
+    ])
+def test_parseScan_delimiters(data):
+    assert receiving.parseScan(data) == expected
+
+def test_parseScan_mixed_delimiters():
+    with pytest.raises(ScanFormatError):
+        receiving.parseScan('40012345|ABC-1#3|12')
+
+####################
+#       JSON       #
+####################
+
+def test_parseJSON():
+    assert receiving.parseScan('{"PO":"40012345","item":"ABC-1","line":3,"quantity":12}') == expected
+
+def test_parseJSON_key_aliases():
+    assert receiving.parseScan('{"purchaseOrder":40012345,"ItemNumber":"ABC-1","L":"3","qty":"12"}') \
+        == expected
+
+def test_parseJSON_without_line():
+    assert receiving.parseScan('{"po":"40012345","in":"ABC-1","q":12}') == QRCode('40012345', 'ABC-1', 0, 12)
+
+@pytest.mark.parametrize('data', [
+    '{"PO":"40012345","item":"ABC-1"',
+    '["40012345","ABC-1",3,12]',
+    '{"PO":"40012345","item":"ABC-1","line":3}',
+    '{"PO":"40012345","item":"ABC-1","line":3,"quantity":"many"}',
+    '{"PO":"40012345","item":"ABC-1","line":3,"quantity":2.5}',
+    '{"PO":"40012345","item":"ABC-1","line":3,"quantity":12.0}',
+    '{"PO":"40012345","item":"ABC-1","line":3,"quantity":true}',
+    '{"PO":"40012345","item":"ABC-1","line":1.5,"quantity":12}',
+    '{"PO":"40012345","item":"ABC-1","line":true,"quantity":12}',
+    ])
+def test_parseJSON_rejects(data):
+    with pytest.raises(ScanFormatError):
+        receiving.parseScan(data)
+
+####################
+#       GS1        #
+####################
+
+@pytest.mark.parametrize('data', [
+    ']Q340040012345\x1d241ABC-1\x1d913\x1d3012',
+    ']d240040012345\x1d241ABC-1\x1d913\x1d3012',
+    '\x1d40040012345\x1d241ABC-1\x1d913\x1d3012',
+    '(400)40012345(241)ABC-1(91)3(30)12',
+    ])
+def test_parseGS1(data):
+    assert receiving.parseScan(data) == expected
+
+def test_parseGS1_decoded_scan():
+    data = receiving.decodeScan(b'\x1d40040012345\x1d241ABC-1\x1d913\x1d3012\r\n')
+    assert receiving.classifyScan(data) == 'qr'
+    assert receiving.parseScan(data) == expected
+
+def test_parseGS1_fixed_length_gtin():
+    assert receiving.parseScan('\x1d0109506000134352\x1d40040012345\x1d3712') \
+        == QRCode('40012345', '09506000134352', 0, 12)
+
+def test_parseGS1_separator(monkeypatch):
+    monkeypatch.setattr(receiving, 'fnc1Separator', '|')
+    data = receiving.decodeScan(b'\x1d40040012345\x1d241ABC-1\x1d913\x1d3012\r\n')
+    assert receiving.parseScan(data) == expected
+
+@pytest.mark.parametrize('data', [
+    '\x1d40040012345\x1d241ABC-1',
+    '\x1d0109506\x1d40040012345\x1d3012',
+    '\x1dAB12345',
+    ])
+def test_parseGS1_rejects(data):
+    with pytest.raises(ScanFormatError):
+        receiving.parseScan(data)
+
+####################
+#     CLASSIFY     #
+####################
+
+@pytest.mark.parametrize('data, kind', [
+    ('setMode:bbb', 'mode'),
+    ('bypassSub', 'bypass'),
+    ('40012345#ABC-1#3#12', 'qr'),
+    ('40012345|ABC-1|3|12', 'qr'),
+    ('{"PO":"40012345"}', 'qr'),
+    ('(400)40012345', 'qr'),
+    ('SUB1', 'text'),
+    ])
+def test_classifyScan(data, kind):
+    assert receiving.classifyScan(data) == kind
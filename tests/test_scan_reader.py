@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Tests for the scan framing of receiving_v4.py
+'''
+
+from receiving_v4 import FrameAssembler
+
+def frames(assembler):
+    result = []
+    while True:
+        frame = assembler.popFrame()
+        if frame is None:
+            return result
+        result.append(frame)
+
+def test_splits_on_terminators():
+    assembler = FrameAssembler()
+    assembler.feed(b'1234567#ABC-1#3#12\r\n7654321#XYZ-9#1#5\r\n')
+    assert frames(assembler) == [b'1234567#ABC-1#3#12', b'7654321#XYZ-9#1#5']
+    assert not assembler.pending()
+
+def test_joins_scans_split_across_chunks():
+    assembler = FrameAssembler()
+    assembler.feed(b'1234567#AB')
+    assert frames(assembler) == []
+    assert assembler.pending()
+    assembler.feed(b'C-1#3#12\r')
+    assembler.feed(b'\nSUB1\r\n')
+    assert frames(assembler) == [b'1234567#ABC-1#3#12', b'SUB1']
+
+def test_other_terminators():
+    assembler = FrameAssembler(terminators=b'\x1d\x03')
+    assembler.feed(b'SUB1\x03SUB2\x1d')
+    assert frames(assembler) == [b'SUB1', b'SUB2']
+
+def test_gap_ends_unterminated_scan():
+    assembler = FrameAssembler(gapTimeout=0.05)
+    assembler.feed(b'SUB1', now=100.0)
+    assembler.expire(now=100.01)
+    assert frames(assembler) == []
+    assembler.expire(now=100.1)
+    assert frames(assembler) == [b'SUB1']
+
+def test_discards_oversized_scan():
+    assembler = FrameAssembler(maxLength=8)
+    assembler.feed(b'0123456789')
+    assert not assembler.pending()
+    assert assembler.dropped == 1
+    assembler.feed(b'SUB1\r\n')
+    assert frames(assembler) == [b'SUB1']
+
+def test_drops_oldest_past_max_frames():
+    assembler = FrameAssembler(maxFrames=2)
+    assembler.feed(b'A\r\nB\r\nC\r\n')
+    assert frames(assembler) == [b'B', b'C']
+    assert assembler.dropped == 1
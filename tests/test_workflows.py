@@ -0,0 +1,233 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Tests for the workflow resume and back-out logic and the duplicate scan
+checks of receiving_v4.py
+'''
+
+import pytest
+
+import receiving_v4 as receiving
+from receiving_v4 import RecorderBackend, ScanCache
+
+scan = '1234567#ABC-1#3#12'
+other = '7654321#XYZ-9#1#5'
+
+@pytest.fixture(autouse=True)
+def session(monkeypatch):
+    monkeypatch.setattr(receiving.sessionInfo, 'port', 'COM3', raising=False)
+    monkeypatch.setattr(receiving.sessionInfo, 'mode', 'bbb', raising=False)
+    monkeypatch.setattr(receiving, 'scanCache', ScanCache(ttl=60, maxSize=100))
+    monkeypatch.setattr(receiving, 'resumeWorkflows', True)
+    for workflow in (receiving.receiptWorkflow, receiving.correctionWorkflow):
+        monkeypatch.setattr(workflow, 'suspended', {})
+
+@pytest.fixture
+def keyboard():
+    return RecorderBackend()
+
+# Scan each of &scans into &workflow and return the final (done, mode)
+def feed(workflow, keyboard, context, *scans):
+    result = None
+    for data in scans:
+        result = workflow.advance(keyboard, context, data)
+    return result
+
+def typed(keyboard):
+    return [value for event, value in keyboard.take() if event == 'type']
+
+####################
+#  RESUME / DROP   #
+####################
+
+def test_receipt_runs_to_completion(keyboard):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    assert feed(workflow, keyboard, context, scan, 'SUB1') == (False, None)
+    assert context.state == 'next'
+    assert feed(workflow, keyboard, context, 'setMode:findReceipt') == (True, 'findReceipt')
+    assert typed(keyboard)[:4] == ['1234567', 'ABC-1', '12', 'SUB1']
+
+def test_other_mode_suspends_and_resumes(keyboard):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    assert feed(workflow, keyboard, context, 'setMode:printData') == (True, 'printData')
+
+    resumed = workflow.begin()
+    assert resumed is context
+    assert resumed.state == 'sub'
+    keyboard.take()
+    feed(workflow, keyboard, resumed, 'SUB1')
+    assert resumed.state == 'next'
+    assert typed(keyboard)[0] == 'SUB1'
+
+def test_same_mode_backs_out(keyboard):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    assert feed(workflow, keyboard, context, 'setMode:bbb') == (True, 'bbb')
+
+    restarted = workflow.begin()
+    assert restarted is not context
+    assert restarted.state == 'qr'
+    assert workflow.suspended == {}
+
+def test_mode_without_handler_backs_out(keyboard):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    assert feed(workflow, keyboard, context, 'setMode:nonsense') == (True, 'nonsense')
+    assert workflow.begin().state == 'qr'
+
+def test_timeout_always_resumes(keyboard):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    workflow.interrupt(context, None)
+    assert workflow.begin() is context
+
+def test_nothing_kept_before_first_scan(keyboard):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    assert feed(workflow, keyboard, context, 'setMode:aaa') == (True, 'aaa')
+    assert workflow.suspended == {}
+
+def test_resume_turned_off(keyboard, monkeypatch):
+    monkeypatch.setattr(receiving, 'resumeWorkflows', False)
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan, 'setMode:printData')
+    assert workflow.begin().state == 'qr'
+
+def test_suspended_per_port(keyboard, monkeypatch):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan, 'setMode:printData')
+
+    monkeypatch.setattr(receiving.sessionInfo, 'port', 'COM4')
+    assert workflow.begin().state == 'qr'
+    monkeypatch.setattr(receiving.sessionInfo, 'port', 'COM3')
+    assert workflow.begin() is context
+
+####################
+#  DUPLICATE SCANS #
+####################
+
+def test_saved_receipt_is_a_duplicate(keyboard):
+    workflow = receiving.receiptWorkflow
+    feed(workflow, keyboard, workflow.begin(), scan, 'SUB1')
+
+    context = workflow.begin()
+    keyboard.take()
+    assert feed(workflow, keyboard, context, scan) == (False, None)
+    assert context.state == 'qr'
+    assert keyboard.take() == []
+
+def test_unsaved_receipt_is_not_a_duplicate(keyboard):
+    workflow = receiving.receiptWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    assert receiving.scanCache.seen('receipt\t' + scan) is None
+
+def test_dropped_receipt_can_be_scanned_again(keyboard):
+    workflow = receiving.receiptWorkflow
+    feed(workflow, keyboard, workflow.begin(), scan, 'setMode:bbb')
+
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    assert context.state == 'sub'
+
+def test_override_enters_a_duplicate(keyboard):
+    workflow = receiving.receiptWorkflow
+    feed(workflow, keyboard, workflow.begin(), scan, 'SUB1')
+
+    context = workflow.begin()
+    feed(workflow, keyboard, context, receiving.overrideScan, scan)
+    assert context.state == 'sub'
+    assert context.override is False
+
+def test_override_covers_one_scan_only(keyboard):
+    workflow = receiving.receiptWorkflow
+    feed(workflow, keyboard, workflow.begin(), scan, 'SUB1')
+    feed(workflow, keyboard, workflow.begin(), other, 'SUB1')
+
+    context = workflow.begin()
+    feed(workflow, keyboard, context, receiving.overrideScan, scan, 'SUB1')
+    context = workflow.begin()
+    feed(workflow, keyboard, context, other)
+    assert context.state == 'qr'
+
+def test_duplicates_are_per_workflow(keyboard):
+    feed(receiving.receiptWorkflow, keyboard, receiving.receiptWorkflow.begin(), scan, 'SUB1')
+
+    workflow = receiving.correctionWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    assert context.state == 'first'
+
+def test_correction_remembered_once_finished(keyboard):
+    workflow = receiving.correctionWorkflow
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan, '4')
+    assert receiving.scanCache.seen('correction\t' + scan) is None
+    assert feed(workflow, keyboard, context, '4') == (True, '4')
+    assert receiving.scanCache.seen('correction\t' + scan) is not None
+
+def test_no_cache_no_check(keyboard, monkeypatch):
+    monkeypatch.setattr(receiving, 'scanCache', None)
+    workflow = receiving.receiptWorkflow
+    feed(workflow, keyboard, workflow.begin(), scan, 'SUB1')
+
+    context = workflow.begin()
+    feed(workflow, keyboard, context, scan)
+    assert context.state == 'sub'
+
+####################
+#    SCAN CACHE    #
+####################
+
+def test_cache_expires_after_ttl():
+    cache = ScanCache(ttl=60, maxSize=10)
+    cache.add('a')
+    assert cache.seen('a') is not None
+    cache.entries['a'] -= 61
+    assert cache.seen('a') is None
+    assert 'a' not in cache.entries
+
+def test_cache_evicts_least_recently_used():
+    cache = ScanCache(ttl=60, maxSize=2)
+    cache.add('a')
+    cache.add('b')
+    cache.seen('a')
+    cache.add('c')
+    assert cache.seen('b') is None
+    assert cache.seen('a') is not None
+    assert cache.seen('c') is not None
+
+def test_cache_reloads_unexpired_entries(tmp_path):
+    fname = str(tmp_path / 'ScanCache.txt')
+    cache = ScanCache(ttl=60, maxSize=10, fname=fname)
+    cache.add('receipt\t' + scan)
+    cache.close()
+    with open(fname, 'a') as stale:
+        stale.write('1000\t"receipt\\told"\n')
+        stale.write('garbage\n')
+
+    reloaded = ScanCache(ttl=60, maxSize=10, fname=fname)
+    assert reloaded.seen('receipt\t' + scan) is not None
+    assert reloaded.seen('receipt\told') is None
+    reloaded.close()
+    with open(fname) as rewritten:
+        assert len(rewritten.readlines()) == 1
+
+def test_cache_reload_keeps_newest(tmp_path):
+    fname = str(tmp_path / 'ScanCache.txt')
+    cache = ScanCache(ttl=60, maxSize=10, fname=fname)
+    for key in 'abc':
+        cache.add(key)
+    cache.close()
+
+    reloaded = ScanCache(ttl=60, maxSize=2, fname=fname)
+    assert list(reloaded.entries) == ['b', 'c']
+    reloaded.close()